@@ -1,10 +1,20 @@
 from airflow import DAG
 from airflow.operators.python_operator import PythonOperator
+from airflow.operators.dummy_operator import DummyOperator
 from airflow.contrib.sensors.file_sensor import FileSensor
 from datetime import date, timedelta, datetime
+import io
+import json
 
 from db_pack.oanda import fx_oanda_daily
 from db_pack.oanda import fx_oanda_minute
+from q_tools import minio_cache
+
+# One task per (ticker, granularity) of interested_tickers.xlsx, so a slow or failing instrument
+# only delays and retries itself. The daily and minute chains run in parallel, the number of
+# concurrent Oanda downloads is bounded by the OANDA_POOL pool.
+OANDA_POOL = "oanda_api"
+OANDA_POOL_SLOTS = 4 # concurrent candle downloads within the Oanda rate budget
 
 DAG_DEFAULT_ARGS={
     'owner':'airflow',
@@ -13,10 +23,37 @@ DAG_DEFAULT_ARGS={
     'retry_delay':timedelta(minutes=1)
 }
 
+
+def tickers_to_json(body):
+    # interested_tickers.xlsx -> {"daily": [...], "minute": [...]}, so a scheduler parse doesn't need pandas
+    import pandas as pd
+    sheets = pd.read_excel(io.BytesIO(body), sheet_name=["daily", "minute"])
+    return json.dumps(dict((name, list(df['Tickers'].dropna())) for name, df in sheets.items())).encode()
+
+
+def interested_tickers():
+    path = minio_cache.cached_object("airflow-files", "interested_tickers.xlsx", convert=tickers_to_json, suffix=".json")
+    if path is None:
+        return {"daily": [], "minute": []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def ensure_pool():
+    # the pool must exist before the download tasks are queued
+    from airflow.api.common.experimental import pool
+    pool.create_pool(name=OANDA_POOL, slots=OANDA_POOL_SLOTS, description="Oanda candle downloads")
+
+
 with DAG('fx_data_download', start_date=datetime(2019,1,1), schedule_interval='@daily',default_args=DAG_DEFAULT_ARGS, catchup=False) as dag:
-    
-    updating_db_daily = PythonOperator(task_id="updating_db_daily",python_callable=fx_oanda_daily.main)
 
-    updating_db_minute = PythonOperator(task_id="updating_db_minute",python_callable=fx_oanda_minute.main)
+    tickers = interested_tickers()
+
+    creating_pool = PythonOperator(task_id="creating_pool",python_callable=ensure_pool)
 
-    updating_db_daily >> updating_db_minute
+    for granularity, module in [("daily", fx_oanda_daily), ("minute", fx_oanda_minute)]:
+        done = DummyOperator(task_id="updated_db_"+granularity)
+        for ticker in tickers.get(granularity, []):
+            updating_ticker = PythonOperator(task_id="updating_db_"+granularity+"_"+ticker,python_callable=module.update_ticker,
+                                             op_kwargs={'ticker': ticker},pool=OANDA_POOL)
+            creating_pool >> updating_ticker >> done
@@ -5,9 +5,20 @@ from datetime import datetime, timedelta
 from airflow.operators.dummy_operator import DummyOperator
 from airflow.operators.bash_operator import BashOperator
 from datetime import date, timedelta, datetime
+import csv
 import json
-import pandas as pd
-import boto3
+
+from q_tools import minio_cache
+
+
+def load_strategy_sheet():
+    # rows of strategy.csv as dicts, empty cells as ''
+    # the sheet is cached on local disk (see q_tools/minio_cache.py), a scheduler parse normally does no network I/O
+    path = minio_cache.cached_object("airflow-files", "strategy.csv")
+    if path is None:
+        return []
+    with open(path, newline='') as f:
+        return [dict((k, v or '') for k, v in row.items()) for row in csv.DictReader(f)]
 
 
 def create_dag(dag_id,
@@ -26,7 +37,7 @@ def create_dag(dag_id,
             task_id='clear',
             dag=dag
         )
-        for i,row in df.iterrows():
+        for i,row in enumerate(conf):
             command={}
             command['--strat_name']=row['Strategy']
             command['--mode']=str(row['Mode'])
@@ -45,13 +56,7 @@ def create_dag(dag_id,
         return dag
 schedule = None #"@daily"
 dag_id = "strategy_dynamic_DAG"
-s3 = boto3.client('s3',endpoint_url="http://minio-image:9000",aws_access_key_id="minio-image",aws_secret_access_key="minio-image-pass")
-Bucket="airflow-files"
-Key="strategy.csv"
-read_file = s3.get_object(Bucket=Bucket, Key=Key)
-df = pd.read_csv(read_file['Body'],sep=',')
-
-df.fillna('', inplace=True)
+strategy_rows = load_strategy_sheet()
 args = {
     'owner': 'airflow',
     'depends_on_past': False,
@@ -64,4 +69,15 @@ args = {
     'concurrency': 1,
     'max_active_runs': 1
 }
-globals()[dag_id] = create_dag(dag_id, schedule, args, df)
+globals()[dag_id] = create_dag(dag_id, schedule, args, strategy_rows)
+
+# all the backtest rows of the sheet as one task, sharing the bars and the db connections (see q_run/run_BT_batch.py)
+batch_dag_id = "strategy_batch_DAG"
+batch_dag = DAG(batch_dag_id, default_args=args, schedule_interval=schedule)
+with batch_dag:
+    BashOperator(
+        bash_command='python /usr/local/airflow/dags/q_pack/q_run/run_BT_batch.py',
+        task_id='run_BT_batch',
+        dag=batch_dag
+    )
+globals()[batch_dag_id] = batch_dag
@@ -0,0 +1,123 @@
+# Hyperparameter search for the RandomForest model of train.py
+# Random configurations are evaluated on time series cross validation folds across a process pool.
+# Successive halving: every rung evaluates the surviving configurations on eta times more folds
+# (the most recent folds first) and only keeps the best 1/eta of them for the next rung.
+# Every trial and rung is logged as a nested MLflow run under the search run, the best
+# configuration is refit on all the data and logged as the model of the search run.
+
+import itertools
+import os
+import warnings
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.model_selection import TimeSeriesSplit
+
+import mlflow
+import mlflow.sklearn
+
+from train import eval_metrics
+
+# parameter name -> candidate values
+SEARCH_SPACE = {
+    "n_estimators": [50, 100, 200, 400],
+    "max_depth": [3, 5, 10, 20, None],
+    "min_samples_leaf": [1, 5, 20, 50],
+    "max_features": [1.0, 0.7, 0.5, "sqrt"],
+}
+
+# data shared by the pool workers, set once per worker by init_worker
+_X = None
+_y = None
+
+
+def init_worker(X, y):
+    global _X, _y
+    _X, _y = X, y
+
+
+def sample_configs(n_trials, seed=40):
+    # random configurations of the search space, without repetition
+    grid = list(itertools.product(*SEARCH_SPACE.values()))
+    rng = np.random.RandomState(seed)
+    picks = rng.choice(len(grid), size=min(n_trials, len(grid)), replace=False)
+    return [dict(zip(SEARCH_SPACE.keys(), grid[i])) for i in picks]
+
+
+def evaluate(config, folds):
+    # mean metrics of a configuration over the given (train index, test index) folds
+    scores = []
+    for train_idx, test_idx in folds:
+        model = RandomForestRegressor(random_state=40, **config)
+        model.fit(_X[train_idx], _y[train_idx])
+        scores.append(eval_metrics(_y[test_idx], model.predict(_X[test_idx])))
+    return tuple(np.mean(scores, axis=0))
+
+
+def successive_halving(configs, folds, eta, executor):
+    # folds are ordered from the most recent, rung r uses the first eta**r of them
+    survivors = list(enumerate(configs))
+    n_folds, rung = 1, 0
+    while True:
+        used = folds[:n_folds]
+        results = list(executor.map(evaluate, [c for _, c in survivors], [used] * len(survivors)))
+        for (trial, config), (rmse, mae, r2) in zip(survivors, results):
+            with mlflow.start_run(run_name="trial_%d_rung_%d" % (trial, rung), nested=True):
+                mlflow.log_params(dict((k, str(v)) for k, v in config.items()))
+                mlflow.log_param("trial", trial)
+                mlflow.log_param("rung", rung)
+                mlflow.log_param("folds", len(used))
+                mlflow.log_metric("rmse", rmse)
+                mlflow.log_metric("mae", mae)
+                mlflow.log_metric("r2", r2)
+        order = np.argsort([rmse for rmse, mae, r2 in results])
+        ranked = [survivors[i] for i in order]
+        print("Rung %d: %d configurations on %d folds, best rmse %f" % (rung, len(survivors), len(used), results[order[0]][0]))
+        if len(survivors) == 1 or n_folds >= len(folds):
+            return ranked[0], results[order[0]]
+        survivors = ranked[:max(1, len(survivors) // eta)]
+        n_folds = min(n_folds * eta, len(folds))
+        rung += 1
+
+
+if __name__ == "__main__":
+    warnings.filterwarnings("ignore")
+    np.random.seed(40)
+
+    log_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ml_log_processed.csv")
+    data = pd.read_csv(log_path) # rows are in time order, see ml_preprocessing
+
+    mlflow.tracking.set_tracking_uri('http://mlflow-image:5500')
+
+    n_trials = int(sys.argv[1]) if len(sys.argv) > 1 else 81
+    eta = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    n_splits = int(sys.argv[3]) if len(sys.argv) > 3 else 9
+    processes = int(sys.argv[4]) if len(sys.argv) > 4 and int(sys.argv[4]) > 0 else None
+
+    X = data.drop(["fwd_returns"], axis=1).values
+    y = data["fwd_returns"].values
+    # expanding window folds, the test fold always comes after its training data
+    folds = list(TimeSeriesSplit(n_splits=n_splits).split(X))[::-1]
+
+    with mlflow.start_run(run_name="search"):
+        mlflow.log_param("n_trials", n_trials)
+        mlflow.log_param("eta", eta)
+        mlflow.log_param("n_splits", n_splits)
+        with ProcessPoolExecutor(max_workers=processes, initializer=init_worker, initargs=(X, y)) as executor:
+            (trial, config), (rmse, mae, r2) = successive_halving(sample_configs(n_trials), folds, eta, executor)
+
+        print("Best RandomForest Model (trial %d): %s" % (trial, config))
+        print("  RMSE: %s" % rmse)
+        print("  MAE: %s" % mae)
+        print("  R2: %s" % r2)
+
+        lr = RandomForestRegressor(random_state=40, **config)
+        lr.fit(X, y)
+        mlflow.log_params(dict(("best_" + k, str(v)) for k, v in config.items()))
+        mlflow.log_metric("rmse", rmse)
+        mlflow.log_metric("r2", r2)
+        mlflow.log_metric("mae", mae)
+        mlflow.sklearn.log_model(lr, "model")
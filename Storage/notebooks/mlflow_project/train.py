@@ -11,6 +11,7 @@ import numpy as np
 from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
 from sklearn.model_selection import train_test_split
 from sklearn.linear_model import ElasticNet
+from sklearn.ensemble import RandomForestRegressor
 
 import mlflow
 import mlflow.sklearn
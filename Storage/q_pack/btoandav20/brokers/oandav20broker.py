@@ -146,6 +146,7 @@ class OandaV20Broker(with_metaclass(MetaOandaV20Broker, BrokerBase)):
         order = self.orders[oref]
         order.reject()
         self.notify(order)
+        self.o.latency.discard(oref)
 
     def _accept(self, oref):
         order = self.orders[oref]
@@ -156,11 +157,13 @@ class OandaV20Broker(with_metaclass(MetaOandaV20Broker, BrokerBase)):
         order = self.orders[oref]
         order.cancel()
         self.notify(order)
+        self.o.latency.discard(oref)
 
     def _expire(self, oref):
         order = self.orders[oref]
         order.expire()
         self.notify(order)
+        self.o.latency.discard(oref)
 
     def _bracketize(self, order):
         pref = getattr(order.parent, 'ref', order.ref)  # parent ref or self
@@ -254,6 +257,8 @@ class OandaV20Broker(with_metaclass(MetaOandaV20Broker, BrokerBase)):
             self.notify(order)
             self._bracketize(order)
 
+        self.o.latency.stamp(oref, 'notify')
+
     def _transmit(self, order):
         oref = order.ref
         pref = getattr(order.parent, 'ref', oref)  # parent ref or self
@@ -279,6 +284,17 @@ class OandaV20Broker(with_metaclass(MetaOandaV20Broker, BrokerBase)):
         self.opending[pref].append(order)
         return order
 
+    def _stamp_submit(self, order):
+        # market orders are measured against the last seen close
+        if order.exectype in [None, Order.Market]:
+            refprice = order.data.close[0]
+        else:
+            refprice = order.created.price
+
+        self.o.latency.stamp(order.ref, 'submit', price=refprice,
+                             instrument=order.data._dataname,
+                             isbuy=order.isbuy())
+
     def buy(self, owner, data,
             size, price=None, plimit=None,
             exectype=None, valid=None, tradeid=0, oco=None,
@@ -294,6 +310,7 @@ class OandaV20Broker(with_metaclass(MetaOandaV20Broker, BrokerBase)):
 
         order.addinfo(**kwargs)
         order.addcomminfo(self.getcommissioninfo(data))
+        self._stamp_submit(order)
         return self._transmit(order)
 
     def sell(self, owner, data,
@@ -311,6 +328,7 @@ class OandaV20Broker(with_metaclass(MetaOandaV20Broker, BrokerBase)):
 
         order.addinfo(**kwargs)
         order.addcomminfo(self.getcommissioninfo(data))
+        self._stamp_submit(order)
         return self._transmit(order)
 
     def cancel(self, order):
@@ -2,6 +2,7 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import bisect
 import collections
 import json
 import threading
@@ -45,6 +46,137 @@ class SerializableEvent(object):
         if d['evt']:
             self.evt.set()
 
+class OrderLatency(object):
+    '''Timestamps the order path of the broker/store and aggregates the
+    time spent in each stage into latency histograms.
+
+    Stages (in order):
+
+      - ``submit``: order created by the strategy (``buy``/``sell``)
+      - ``transmit``: order sent by ``order_create`` (for a bracket, the parent
+        once the last child releases it)
+      - ``dequeue``: order taken from ``q_ordercreate``
+      - ``response``: REST response for the order creation received
+      - ``stream``: ``ORDER_FILL`` transaction received from the stream
+      - ``notify``: fill notified to the strategy in ``_fill``
+
+    The latency of a stage is the time elapsed since the previous stage
+    recorded for the same order. Once an order is notified, a per order
+    record with the queueing delay and the slippage against the reference
+    price taken at submission is kept in ``records``.
+    '''
+    STAGES = ('submit', 'transmit', 'dequeue', 'response', 'stream', 'notify')
+    # upper bounds of the histogram buckets in milliseconds
+    BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, maxrecords=1000):
+        self._lock = threading.Lock()
+        self._stamps = dict()  # order ref -> [stage timestamps, info]
+        self.hist = dict((s, [0] * (len(self.BUCKETS) + 1))
+                         for s in self.STAGES[1:])
+        self.total = dict((s, 0.0) for s in self.STAGES[1:])
+        self.records = collections.deque(maxlen=maxrecords)
+        self._lastsummary = _time.time()
+
+    def stamp(self, oref, stage, price=None, **kwargs):
+        '''Records the time at which order ``oref`` reached ``stage``. Only
+        orders which went through ``submit`` are tracked'''
+        now = _time.time()
+        with self._lock:
+            if stage == 'submit':
+                info = dict(ref=oref, refprice=price)
+                info.update(kwargs)
+                self._stamps[oref] = [dict(submit=now), info]
+                return
+
+            entry = self._stamps.get(oref, None)
+            if entry is None or stage in entry[0]:
+                return  # untracked order or stage already seen
+
+            stamps, info = entry
+            last = max(stamps.values())
+            self._add(stage, now - last)
+            stamps[stage] = now
+            if price is not None:
+                info['fillprice'] = price
+
+            if stage == 'notify':
+                self._stamps.pop(oref)
+                self.records.append(self._record(stamps, info))
+
+    def discard(self, oref):
+        '''Stops tracking order ``oref`` (rejected, cancelled, ...)'''
+        with self._lock:
+            self._stamps.pop(oref, None)
+
+    def _add(self, stage, elapsed):
+        ms = elapsed * 1000.0
+        idx = bisect.bisect_left(self.BUCKETS, ms)
+        self.hist[stage][idx] += 1
+        self.total[stage] += ms
+
+    def _record(self, stamps, info):
+        record = dict(info)
+        t0 = stamps['submit']
+        for stage, t in stamps.items():
+            record[stage] = t - t0
+
+        record['queue_delay'] = None
+        if 'dequeue' in stamps and 'transmit' in stamps:
+            record['queue_delay'] = stamps['dequeue'] - stamps['transmit']
+
+        record['slippage'] = None
+        refprice, fillprice = info.get('refprice'), info.get('fillprice')
+        if refprice is not None and fillprice is not None:
+            # positive slippage is a worse price than the reference
+            sign = 1.0 if info.get('isbuy', True) else -1.0
+            record['slippage'] = sign * (fillprice - refprice)
+
+        return record
+
+    def percentile(self, stage, pct):
+        '''Returns the upper bound (ms) of the bucket holding ``pct``'''
+        hist = self.hist[stage]
+        count = sum(hist)
+        if not count:
+            return None
+
+        target, seen = count * pct / 100.0, 0
+        for idx, n in enumerate(hist):
+            seen += n
+            if seen >= target:
+                break
+
+        return self.BUCKETS[idx] if idx < len(self.BUCKETS) else float('inf')
+
+    def summary_due(self, freq):
+        '''Returns ``True`` once every ``freq`` seconds'''
+        if not freq:
+            return False
+
+        now = _time.time()
+        if now - self._lastsummary < freq:
+            return False
+
+        self._lastsummary = now
+        return True
+
+    def summary(self):
+        '''Returns a one line per stage summary of the latencies'''
+        lines = ['Order latency (ms): stage count mean p50 p95 p99']
+        with self._lock:
+            for stage in self.STAGES[1:]:
+                count = sum(self.hist[stage])
+                if not count:
+                    continue
+                lines.append('{} {} {:.1f} <={} <={} <={}'.format(
+                    stage, count, self.total[stage] / count,
+                    self.percentile(stage, 50), self.percentile(stage, 95),
+                    self.percentile(stage, 99)))
+
+        return '\n'.join(lines)
+
+
 class MetaSingleton(MetaParams):
     '''Metaclass to make a metaclassed class a singleton'''
     def __init__(cls, name, bases, dct):
@@ -70,21 +202,34 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
 
       - ``practice`` (default: ``False``): use the test environment
 
-      - ``account_poll_freq`` (default: ``10.0``): refresh frequency for account
-        value/cash refresh
+      - ``account_poll_freq`` (default: ``60.0``): frequency of the account
+        reconciliation. Balance and cash are kept current from the
+        transaction stream, the reconciliation only fetches the account
+        changes since the last seen transaction
 
      - ``stream_timeout`` (default: ``10``): timeout for stream requests
 
      - ``poll_timeout`` (default: ``2``): timeout for poll requests
+
+     - ``latency_summary_freq`` (default: ``60.0``): frequency in seconds
+       of the order latency summary put into the store notifications.
+       ``0`` disables the summary (the stats are still collected)
+
+     - ``order_workers`` (default: ``4``): number of threads sending order
+       creations to Oanda. Orders are routed by instrument, so orders of the
+       same instrument keep their sequence while independent instruments
+       are sent concurrently
     '''
 
     params = (
         ('token', ''),
         ('account', ''),
         ('practice', False),
-        ('account_poll_freq', 10.0),  # account balance refresh timeout
+        ('account_poll_freq', 60.0),  # account reconciliation timeout
         ('stream_timeout', 10),
         ('poll_timeout', 2),
+        ('latency_summary_freq', 60.0),
+        ('order_workers', 4),
     )
 
     BrokerCls = None  # broker class will auto register
@@ -151,6 +296,9 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
         self._cash = 0.0 # margin available, currently available cash
         self._value = 0.0 # account balance
         self._currency = None # account currency
+        self._last_transid = None # last transaction applied to the account
+        # the account state is written by the transaction stream and the account threads
+        self._acct_lock = threading.Lock()
 
         self.broker = None  # broker instance
         self.datas = list()  # datas that have registered over start
@@ -158,21 +306,26 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
         self._env = None  # reference to cerebro for general notifications
         self._evt_acct = SerializableEvent()
         self._orders = collections.OrderedDict()  # map order.ref to order id
+        self.latency = OrderLatency()  # order path timestamps
 
         # init oanda v20 api context
-        self.oapi = v20.Context(
-            self._OAPI_URL[int(self.p.practice)],
-            poll_timeout=self.p.poll_timeout,
+        self.oapi = self._rest_context()
+
+        # init oanda v20 api stream context
+        self.oapi_stream = v20.Context(
+            self._OAPI_STREAM_URL[int(self.p.practice)],
+            stream_timeout=self.p.stream_timeout,
             port=443,
             ssl=True,
             token=self.p.token,
             datetime_format="UNIX",
         )
 
-        # init oanda v20 api stream context
-        self.oapi_stream = v20.Context(
-            self._OAPI_STREAM_URL[int(self.p.practice)],
-            stream_timeout=self.p.stream_timeout,
+    def _rest_context(self):
+        '''Returns a new oanda v20 api context for REST requests'''
+        return v20.Context(
+            self._OAPI_URL[int(self.p.practice)],
+            poll_timeout=self.p.poll_timeout,
             port=443,
             ssl=True,
             token=self.p.token,
@@ -201,7 +354,8 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
     def stop(self):
         # signal end of thread
         if self.broker is not None:
-            self.q_ordercreate.put(None)
+            for q in self.q_ordercreate:
+                q.put(None)
             self.q_orderclose.put(None)
             self.q_account.put(None)
 
@@ -211,6 +365,9 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
 
     def get_notifications(self):
         '''Return the pending "store" notifications'''
+        if self.latency.summary_due(self.p.latency_summary_freq):
+            self.put_notification(self.latency.summary())
+
         self.notifs.append(None)  # put a mark / threads could still append
         return [x for x in iter(self.notifs.popleft, None)]
 
@@ -312,10 +469,14 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
         t.daemon = True
         t.start()
 
-        self.q_ordercreate = queue.Queue()
-        t = threading.Thread(target=self._t_order_create)
-        t.daemon = True
-        t.start()
+        # one queue per order worker, see _order_queue
+        self.q_ordercreate = list()
+        for i in range(max(1, self.p.order_workers)):
+            q = queue.Queue()
+            self.q_ordercreate.append(q)
+            t = threading.Thread(target=self._t_order_create, args=(q,))
+            t.daemon = True
+            t.start()
 
         self.q_orderclose = queue.Queue()
         t = threading.Thread(target=self._t_order_cancel)
@@ -387,7 +548,15 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
         ).dict()
 
         okwargs.update(**kwargs)  # anything from the user
-        self.q_ordercreate.put((order.ref, okwargs,))
+
+        # the children travel with the parent, only the parent path is timed
+        for o in stopside, takeside:
+            if o is not None:
+                self.latency.discard(o.ref)
+
+        # brackets travel as a single order with the stop/take sides attached
+        self.latency.stamp(order.ref, 'transmit')
+        self._order_queue(okwargs['instrument']).put((order.ref, okwargs,))
 
         # notify orders of being submitted
         self.broker._submit(order.ref)
@@ -398,6 +567,11 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
 
         return order
 
+    def _order_queue(self, instrument):
+        '''Returns the order creation queue serving ``instrument``'''
+        idx = hash(instrument) % len(self.q_ordercreate)
+        return self.q_ordercreate[idx]
+
     def order_cancel(self, order):
         '''Cancels a order'''
         self.q_orderclose.put(order.ref)
@@ -459,27 +633,95 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
                 msg = self.q_account.get(timeout=self.p.account_poll_freq)
                 if msg is None:
                     break  # end of thread
-            except queue.Empty:  # tmout -> time to refresh
+                # coalesce the requests queued by the transaction stream
+                while not self.q_account.empty():
+                    if self.q_account.get_nowait() is None:
+                        return
+            except queue.Empty:  # tmout -> time to reconcile
                 pass
 
-            try:
-                response = self.oapi.account.summary(self.p.account)
-                accinfo = response.get('account', 200)
-            except Exception as e:
-                self.put_notification(e)
-                print(e, response.get('errorMessage'))
+            if self._last_transid is None:
+                if not self._account_summary():
+                    continue
+            elif not self._account_changes():
                 continue
 
-            try:
-                self._cash = accinfo.marginAvailable
-                self._value = accinfo.balance
-                self._currency = accinfo.currency
-            except KeyError:
-                pass
-
             # notify of success, initialization waits for it
             self._evt_acct.set()
 
+    def _account_summary(self):
+        '''Full account refresh, used to kickstart the account state'''
+        try:
+            response = self.oapi.account.summary(self.p.account)
+            accinfo = response.get('account', 200)
+        except Exception as e:
+            self.put_notification(e)
+            return False
+
+        with self._acct_lock:
+            self._currency = accinfo.currency
+            if self._last_transid is not None and \
+                    int(accinfo.lastTransactionID) < int(self._last_transid):
+                return True  # older than the transactions already applied
+            self._cash = float(accinfo.marginAvailable)
+            self._value = float(accinfo.balance)
+            self._last_transid = accinfo.lastTransactionID
+        return True
+
+    def _account_changes(self):
+        '''Reconciles the account with the changes since the last seen
+        transaction'''
+        with self._acct_lock:
+            sinceid = self._last_transid
+        try:
+            response = self.oapi.account.changes(
+                self.p.account, sinceTransactionID=sinceid)
+            changes = response.get('changes', 200)
+            state = response.get('state', 200)
+            lastid = response.get('lastTransactionID', 200)
+        except Exception as e:
+            self.put_notification(e)
+            return False
+
+        with self._acct_lock:
+            if int(lastid) < int(self._last_transid):
+                # the stream applied newer transactions during the request,
+                # reconcile again from them
+                self.q_account.put(True)
+                return True
+
+            # transactions the stream may have missed
+            for trans in changes.transactions or []:
+                balance = getattr(trans, 'accountBalance', None)
+                if balance is not None:
+                    self._value = float(balance)
+
+            self._cash = float(state.marginAvailable)
+            self._last_transid = lastid
+        return True
+
+    def _account_transaction(self, trans):
+        '''Applies a streamed transaction to the account state'''
+        balance = trans.get('accountBalance', None)
+        if balance is None:
+            return  # no balance change
+
+        with self._acct_lock:
+            if self._last_transid is None:
+                return  # account not kickstarted yet
+
+            if int(trans['id']) <= int(self._last_transid):
+                return  # already seen by the reconciliation
+
+            # realized pl, financing and transfers move the margin available
+            # like the balance. margin changes come with the reconciliation
+            balance = float(balance)
+            self._cash += balance - self._value
+            self._value = balance
+            self._last_transid = trans['id']
+        if trans['type'] in self._X_FILL_TRANS:
+            self.q_account.put(True)  # reconcile margin used by the fill
+
     def _t_candles(self, dataname, dtbegin, dtend, timeframe, compression,
                    candleFormat, includeFirst, onlyComplete, q):
         '''Callback method for candles request'''
@@ -548,11 +790,13 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
                        'STOP_LOSS_ORDER_REJECT',]
     # transactions which can be ignored
     _X_IGNORE_TRANS = ['DAILY_FINANCING',
+                       'TRANSFER_FUNDS',
                        'CLIENT_CONFIGURE']
 
     def _transaction(self, trans):
         oid = None
         ttype = trans['type']
+        self._account_transaction(trans)
 
         if ttype in self._X_CREATE_TRANS:
             # get order id (matches transaction id)
@@ -624,6 +868,7 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
         elif ttype in self._X_FILL_TRANS:
             size = float(trans['units'])
             price = float(trans['price'])
+            self.latency.stamp(oref, 'stream', price=price)
             self.broker._fill(oref, size, price, reason=trans['reason'])
             # store trade ids which were touched by the order
             if 'tradeOpened' in trans:
@@ -641,15 +886,19 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
         elif ttype in self._X_REJECT_TRANS:
                 self.broker._reject(oref)
 
-    def _t_order_create(self):
+    def _t_order_create(self, q):
+        # each worker owns its context, the http session is not shared
+        oapi = self._rest_context()
         while True:
-            msg = self.q_ordercreate.get()
+            msg = q.get()
             if msg is None:
                 break
 
             oref, okwargs = msg
+            self.latency.stamp(oref, 'dequeue')
             try:
-                response = self.oapi.order.create(self.p.account, order=okwargs)
+                response = oapi.order.create(self.p.account, order=okwargs)
+                self.latency.stamp(oref, 'response')
                 # get the transaction which created the order
                 o = response.get("orderCreateTransaction", 201)
             except Exception as e:
@@ -35,6 +35,7 @@ import q_credentials.db_secmaster_cred as db_secmaster_cred
 import q_credentials.oanda_cred as oanda_cred
 
 MASTER_LIST_FAILED_SYMBOLS = []
+INITIAL_START_DATE = datetime.datetime(2019,12,30)
     
 def obtain_list_db_tickers(conn):
     """
@@ -167,9 +168,34 @@ def oanda_historical_data(instrument,start_date,end_date,granularity='M1',client
     df_full.index=pd.to_datetime(df_full.index)    
     return df_full
 
+def update_ticker(ticker):
+    """
+    updates the minute_data of one ticker from its last date in the DB, used by the per ticker tasks of the fx_data_download DAG.
+    Raises if the download fails so that only this ticker is retried
+    args:
+        ticker: Oanda instrument, type string
+    returns:
+        None
+    """
+    conn = psycopg2.connect(host=db_secmaster_cred.dbHost, database=db_secmaster_cred.dbName, user=db_secmaster_cred.dbUser, password=db_secmaster_cred.dbPWD)
+    try:
+        vendor_id = fetch_vendor_id('Oanda', conn)
+        cur = conn.cursor()
+        cur.execute("""select b.id, max(a.date_price) from symbol b left join minute_data a on a.stock_id = b.id
+                    where b.ticker = %s group by b.id""", (ticker,))
+        row = cur.fetchone()
+        if row is None:
+            raise Exception('{} is not in the symbol table'.format(ticker))
+        symbol_id, last_date = row
+        start_date = (last_date if last_date is not None else INITIAL_START_DATE) + datetime.timedelta(minutes=1)
+        load_data(ticker, symbol_id, vendor_id, conn, start_date=start_date)
+    finally:
+        conn.close()
+
+
 def main():
 
-    initial_start_date = datetime.datetime(2019,12,30)
+    initial_start_date = INITIAL_START_DATE
     
     db_host=db_secmaster_cred.dbHost 
     db_user=db_secmaster_cred.dbUser
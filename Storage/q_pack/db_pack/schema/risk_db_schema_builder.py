@@ -137,6 +137,15 @@ def create_risk_tables(db_credential_info):
                         value NUMERIC NULL,
                         FOREIGN KEY (run_id) REFERENCES run_information(run_id)
                         )
+                    """,
+                    """
+                    CREATE TABLE backtest_cache (
+                        cache_key TEXT PRIMARY KEY,
+                        run_id INTEGER NOT NULL,
+                        pnl NUMERIC NULL,
+                        recorded_time TIMESTAMP NOT NULL,
+                        FOREIGN KEY (run_id) REFERENCES run_information(run_id)
+                        )
                     """
                     )
         try:
@@ -0,0 +1,243 @@
+"""
+Feature store for the training data derived from the backtest runs.
+
+Features are keyed by (security, datetime, feature set) and stored once as
+partitioned parquet in Minio:
+    feature-store/<feature_set>/security=<ticker>/year=<YYYY>.parquet
+with a json index per feature set holding the time range of every partition, so
+that time range reads only fetch the overlapping partitions.
+The partitions keep the ohlc bars next to the features: an incremental ingest
+computes the features over the last WARMUP_BARS stored bars followed by the new
+ones, so that recursive indicators (RSI, ATR) continue the stored values instead
+of starting again at the first new bar.
+Ingests of a feature set on the same host are serialized with a file lock around
+the read-modify-write of its partitions and index.
+
+Sample usage
+    ingest_ml_log("2_ml_log.parquet", feature_set="rsi_stoc")
+    data = load_arrays("rsi_stoc", securities=["EUR_USD"], start=datetime.datetime(2019,1,1))
+    X = np.column_stack([data["RSI"], data["STOCHASTIC"]])
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+from io import BytesIO
+
+import boto3
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ml_pack.features import np_indicators
+
+BUCKET = "model-support-files"
+PREFIX = "feature-store/"
+LOCK_DIR = os.environ.get("FEATURE_STORE_LOCK_DIR", os.path.join(tempfile.gettempdir(), "feature-store-locks"))
+WARMUP_BARS = 1000 # stored bars recomputed with the new ones, recursive indicators of period 30 converge well within it
+OHLC = ["open", "high", "low", "close"]
+
+# feature set name -> function of the ohlc arrays returning the feature columns
+FEATURE_SETS = {
+    "rsi_stoc": lambda o, h, l, c: {"RSI": np_indicators.rsi(c, period=30),
+                                    "STOCHASTIC": np_indicators.stochastic(h, l, c, period=20)[0]},
+    "rsi_stoc_atr": lambda o, h, l, c: {"RSI": np_indicators.rsi(c, period=30),
+                                        "STOCHASTIC": np_indicators.stochastic(h, l, c, period=20)[0],
+                                        "ATR": np_indicators.atr(h, l, c, period=5)},
+}
+
+
+def s3_client():
+    return boto3.client('s3',endpoint_url="http://minio-image:9000",aws_access_key_id="minio-image",aws_secret_access_key="minio-image-pass")
+
+
+def index_key(feature_set):
+    return PREFIX + feature_set + "/_index.json"
+
+
+def partition_key(feature_set, security, year):
+    return PREFIX + feature_set + "/security=" + security + "/year=" + str(year) + ".parquet"
+
+
+@contextlib.contextmanager
+def index_lock(feature_set):
+    """
+    exclusive lock on a feature set, shared across the processes of the host
+    args:
+        feature_set: name in FEATURE_SETS, type string
+    """
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    with open(os.path.join(LOCK_DIR, feature_set + ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_index(s3, feature_set):
+    """
+    returns the partition index of a feature set: {key: {security, start, end, rows}}
+    """
+    try:
+        body = s3.get_object(Bucket=BUCKET, Key=index_key(feature_set))['Body'].read()
+    except s3.exceptions.NoSuchKey:
+        return {}
+    return json.loads(body)
+
+
+def write_index(s3, feature_set, index):
+    s3.put_object(Bucket=BUCKET, Key=index_key(feature_set), Body=json.dumps(index, indent=1, sort_keys=True))
+
+
+def read_partition(s3, key, columns=None):
+    body = s3.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+    return pq.read_table(BytesIO(body), columns=columns)
+
+
+def stored_end(index, security):
+    ends = [p["end"] for p in index.values() if p["security"] == security]
+    return pd.Timestamp(max(ends)) if ends else None
+
+
+def stored_tail(s3, index, security, rows):
+    """
+    last stored ohlc bars of a security, for the warm up of the indicators
+    returns:
+        DataFrame with datetime, open, high, low, close columns, None if the partitions have no ohlc bars
+    """
+    tails, count = [], 0
+    for key in sorted((k for k, p in index.items() if p["security"] == security), reverse=True):
+        try:
+            part = read_partition(s3, key, columns=["datetime"] + OHLC).to_pandas()
+        except (KeyError, pa.ArrowInvalid):
+            return None # stored before the ohlc columns were kept
+        part = part.dropna() # rows of a partition rewritten since the ohlc columns were added
+        tails.insert(0, part)
+        count += len(part)
+        if count >= rows:
+            break
+    tail = pd.concat(tails).sort_values("datetime").tail(rows) if tails else None
+    return tail if tail is not None and len(tail) else None
+
+
+def write_features(feature_set, security, bars, s3=None):
+    """
+    computes a feature set over the bars of one security and stores the bars which are not in the store yet.
+    The indicators of the new bars are computed after the last WARMUP_BARS stored bars, or over all the
+    given bars for a new security (or partitions without the ohlc bars), so pass enough history then
+    args:
+        feature_set: name in FEATURE_SETS, type string
+        security: ticker, type string
+        bars: DataFrame with datetime, open, high, low, close columns
+    returns:
+        number of new rows stored
+    """
+    s3 = s3 or s3_client()
+    with index_lock(feature_set):
+        index = read_index(s3, feature_set)
+        bars = bars.sort_values("datetime").drop_duplicates("datetime", keep="last").reset_index(drop=True)
+        last = stored_end(index, security)
+        if last is not None and bars["datetime"].iloc[-1] <= last:
+            return 0 # already computed by a previous run
+
+        if last is not None:
+            warmup = stored_tail(s3, index, security, WARMUP_BARS)
+            if warmup is not None:
+                new_bars = bars.loc[bars["datetime"] > last, ["datetime"] + OHLC]
+                bars = pd.concat([warmup, new_bars]).reset_index(drop=True)
+        features = FEATURE_SETS[feature_set](bars["open"].values, bars["high"].values, bars["low"].values, bars["close"].values)
+        df = pd.DataFrame(dict(datetime=bars["datetime"].values, **dict((c, bars[c].values) for c in OHLC), **features))
+        if last is not None:
+            df = df[df["datetime"] > last] # the warm up bars are already stored
+        df = df.dropna()
+
+        for year, year_df in df.groupby(df["datetime"].dt.year):
+            key = partition_key(feature_set, security, year)
+            if key in index:
+                # bars appended to an existing year, rewrite that partition
+                year_df = pd.concat([read_partition(s3, key).to_pandas(), year_df]).drop_duplicates("datetime", keep="last")
+            buffer = BytesIO()
+            year_df.to_parquet(buffer, index=False, compression='snappy')
+            s3.put_object(Bucket=BUCKET, Key=key, Body=buffer.getvalue())
+            index[key] = {"security": security, "start": str(year_df["datetime"].min()),
+                          "end": str(year_df["datetime"].max()), "rows": len(year_df)}
+        write_index(s3, feature_set, index)
+    return len(df)
+
+
+def ingest_ml_log(input_file, feature_set, bucket="model-support-files"):
+    """
+    adds the bars of a backtest ml log (csv or parquet) to the feature store
+    returns:
+        dict of security -> number of new rows stored
+    """
+    s3 = s3_client()
+    body = s3.get_object(Bucket=bucket, Key=input_file)['Body']
+    if input_file.endswith(".parquet"):
+        log = pd.read_parquet(BytesIO(body.read()), columns=["security", "datetime", "open", "high", "low", "close"])
+    else:
+        log = pd.read_csv(body, usecols=["security", "datetime", "open", "high", "low", "close"], parse_dates=["datetime"])
+    return dict((security, write_features(feature_set, security, bars, s3=s3)) for security, bars in log.groupby("security"))
+
+
+def load_arrays(feature_set, securities=None, start=None, end=None, columns=None):
+    """
+    reads a time range of a feature set straight into numpy arrays
+    args:
+        feature_set: name in FEATURE_SETS, type string
+        securities: tickers to read, all if None, type list
+        start, end: time range (inclusive), open if None, type datetime
+        columns: feature columns to read, all if None, type list
+    returns:
+        dict of column -> numpy array, with the security and datetime columns, sorted by datetime
+    """
+    s3 = s3_client()
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+    tables, names = [], []
+    for key, part in sorted(read_index(s3, feature_set).items()):
+        if securities is not None and part["security"] not in securities:
+            continue
+        if (start is not None and pd.Timestamp(part["end"]) < start) or (end is not None and pd.Timestamp(part["start"]) > end):
+            continue # partition outside of the time range
+        table = read_partition(s3, key, columns=None if columns is None else ["datetime"] + list(columns))
+        dt = table.column("datetime").to_numpy()
+        mask = np.ones(len(dt), dtype=bool)
+        if start is not None:
+            mask &= dt >= start.to_datetime64()
+        if end is not None:
+            mask &= dt <= end.to_datetime64()
+        tables.append(table.filter(pa.array(mask)))
+        names.append(part["security"])
+
+    if not tables:
+        return {}
+    table = pa.concat_tables(tables)
+    arrays = dict((name, table.column(name).to_numpy()) for name in table.column_names)
+    arrays["security"] = np.repeat(np.array(names, dtype=object), [len(t) for t in tables])
+    order = np.argsort(arrays["datetime"], kind="stable")
+    return dict((name, values[order]) for name, values in arrays.items())
+
+
+def load_training_set(feature_set, features, fwd_returns=5, **kwargs):
+    """
+    training arrays from the store, the target is the fwd_returns bars return of the close as in ml_preprocessing
+    args:
+        feature_set: name in FEATURE_SETS, type string
+        features: feature columns of X, type list
+        fwd_returns: number of bars of the returns, type integer
+        kwargs: securities, start, end as in load_arrays
+    returns:
+        tuple of numpy arrays (X, y)
+    """
+    data = load_arrays(feature_set, columns=["close"] + list(features), **kwargs)
+    if not data:
+        return np.empty((0, len(features))), np.empty(0)
+    y = pd.Series(data["close"]).groupby(data["security"]).pct_change(fwd_returns).values
+    X = np.column_stack([data[f] for f in features])
+    valid = ~np.isnan(y)
+    return X[valid], y[valid]
@@ -0,0 +1,102 @@
+"""
+NumPy versions of the backtrader indicators used as model features, computed
+over a whole series at once. The values match the backtrader lines bar by bar,
+bars before the minimum period are NaN.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def sma(x, period):
+    """
+    simple moving average, as bt.indicators.SimpleMovingAverage
+    args:
+        x: values, type array
+        period: averaging window, type integer
+    returns:
+        numpy array
+    """
+    return pd.Series(np.asarray(x, dtype=float)).rolling(period).mean().values
+
+
+def smma(x, period):
+    """
+    smoothed (wilder) moving average, as bt.indicators.SmoothedMovingAverage.
+    The first value is seeded with the simple average of the first period values
+    args:
+        x: values, leading NaNs are skipped, type array
+        period: averaging window, type integer
+    returns:
+        numpy array
+    """
+    x = np.asarray(x, dtype=float)
+    out = np.full(len(x), np.nan)
+    valid = np.flatnonzero(~np.isnan(x))
+    if len(valid) < period:
+        return out
+    start = valid[0] + period - 1
+    seeded = x[start:].copy()
+    seeded[0] = x[valid[0]:start + 1].mean()
+    out[start:] = pd.Series(seeded).ewm(alpha=1.0 / period, adjust=False).mean().values
+    return out
+
+
+def rsi(close, period=14):
+    """
+    relative strength index, as bt.indicators.RSI
+    args:
+        close: close prices, type array
+        period: smoothing window, type integer
+    returns:
+        numpy array
+    """
+    close = np.asarray(close, dtype=float)
+    diff = np.empty(len(close))
+    diff[0] = np.nan
+    diff[1:] = np.diff(close)
+    upday = np.where(np.isnan(diff), np.nan, np.maximum(diff, 0.0))
+    downday = np.where(np.isnan(diff), np.nan, np.maximum(-diff, 0.0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rs = smma(upday, period) / smma(downday, period)
+        return 100.0 - 100.0 / (1.0 + rs)
+
+
+def stochastic(high, low, close, period=14, period_dfast=3, period_dslow=3):
+    """
+    slow stochastic, as bt.indicators.Stochastic
+    args:
+        high, low, close: prices, type array
+        period: lookback of the highest high and lowest low, type integer
+        period_dfast: smoothing of the fast %K, type integer
+        period_dslow: smoothing of the slow %K into %D, type integer
+    returns:
+        tuple of numpy arrays (percK, percD)
+    """
+    hh = pd.Series(np.asarray(high, dtype=float)).rolling(period).max().values
+    ll = pd.Series(np.asarray(low, dtype=float)).rolling(period).min().values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k_fast = 100.0 * (np.asarray(close, dtype=float) - ll) / (hh - ll)
+    perc_k = sma(k_fast, period_dfast)
+    return perc_k, sma(perc_k, period_dslow)
+
+
+def atr(high, low, close, period=14):
+    """
+    average true range, as bt.indicators.ATR
+    args:
+        high, low, close: prices, type array
+        period: smoothing window, type integer
+    returns:
+        numpy array
+    """
+    high = np.asarray(high, dtype=float)
+    low = np.asarray(low, dtype=float)
+    prev_close = np.empty(len(close))
+    prev_close[0] = np.nan
+    prev_close[1:] = np.asarray(close, dtype=float)[:-1]
+    true_high = np.fmax(high, prev_close)
+    true_low = np.fmin(low, prev_close)
+    tr = true_high - true_low
+    tr[0] = np.nan  # backtrader's true range starts at the second bar
+    return smma(tr, period)
@@ -1,19 +1,116 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import boto3
-from io import StringIO
+from io import BytesIO, StringIO
+
+def read_log(s3,Bucket,Key):
+    # reads one ml log object, parquet or csv
+    read_file = s3.get_object(Bucket=Bucket, Key=Key)
+    if Key.endswith(".parquet"):
+        return pd.read_parquet(BytesIO(read_file['Body'].read())).set_index('datetime')
+    return pd.read_csv(read_file['Body'],sep=',',index_col=['datetime'],parse_dates=True)
 
 def ml_preprocessing(input_file,bucket="model-support-files",fwd_returns=5):
     s3 = boto3.client('s3',endpoint_url="http://minio-image:9000",aws_access_key_id="minio-image",aws_secret_access_key="minio-image-pass")
     Bucket=bucket
     Key=input_file
-    read_file = s3.get_object(Bucket=Bucket, Key=Key)
-    df = pd.read_csv(read_file['Body'],sep=',',index_col=['datetime'],parse_dates=True)
+    if Key.endswith("/"):
+        # chunked log of an incremental capture, one object per chunk
+        chunks = s3.list_objects_v2(Bucket=Bucket, Prefix=Key).get('Contents', [])
+        df = pd.concat([read_log(s3,Bucket,c['Key']) for c in sorted(chunks, key=lambda c: c['Key'])])
+    else:
+        df = read_log(s3,Bucket,Key)
+    Key = Key.rstrip("/").replace(".parquet","").replace(".csv","")+".csv" # the processed output stays a csv
     df=df.loc[:, df.columns != 'ATR'] # Removing the ATR indicator if it exists
-    df['fwd_returns']=df.groupby("security")["close"].pct_change(5)
+    df['fwd_returns']=df.groupby("security")["close"].pct_change(fwd_returns)
     df.sort_values(by='datetime',inplace=True)
     df=df.reset_index().drop(columns=['datetime','security','close'])
     csv_buffer = StringIO()
     df.dropna(inplace=True)
     df.to_csv(csv_buffer,index=False)
     s3.put_object(Bucket=Bucket, Key=("processed_"+Key),Body=csv_buffer.getvalue())
-    return ("processed_"+Key)
\ No newline at end of file
+    return ("processed_"+Key)
+
+####
+# Out-of-core mode: the log is streamed in chunks and split into per security spill files on local disk,
+# then every security is processed chunk by chunk (in parallel across securities) and written as
+# partitioned parquet: processed_<log>/security=<ticker>/part-NNNNN.parquet
+####
+
+def s3_client():
+    return boto3.client('s3',endpoint_url="http://minio-image:9000",aws_access_key_id="minio-image",aws_secret_access_key="minio-image-pass")
+
+def iter_log_chunks(s3,Bucket,Key,chunksize,tmp_dir):
+    # yields the log in DataFrames of at most chunksize rows, in file order
+    if Key.endswith("/"):
+        chunks = s3.list_objects_v2(Bucket=Bucket, Prefix=Key).get('Contents', [])
+        for c in sorted(chunks, key=lambda c: c['Key']):
+            for df in iter_log_chunks(s3,Bucket,c['Key'],chunksize,tmp_dir):
+                yield df
+    elif Key.endswith(".parquet"):
+        local_file = os.path.join(tmp_dir, "input.parquet") # parquet needs a seekable file, spill it to disk
+        s3.download_file(Bucket, Key, local_file)
+        for batch in pq.ParquetFile(local_file).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+        os.remove(local_file)
+    else:
+        read_file = s3.get_object(Bucket=Bucket, Key=Key)
+        for df in pd.read_csv(read_file['Body'],sep=',',parse_dates=['datetime'],chunksize=chunksize):
+            yield df
+
+def process_security(spill_file,security,Bucket,out_prefix,fwd_returns,chunksize):
+    # returns over the chunks of one security, the last fwd_returns closes of a chunk are carried into the next
+    s3 = s3_client()
+    carry = pd.Series(dtype=float)
+    for part, batch in enumerate(pq.ParquetFile(spill_file).iter_batches(batch_size=chunksize)):
+        df = batch.to_pandas()
+        df = df.loc[:, df.columns != 'ATR'] # Removing the ATR indicator if it exists
+        close = pd.concat([carry, df['close']], ignore_index=True)
+        df['fwd_returns'] = close.pct_change(fwd_returns).values[len(carry):]
+        carry = close.iloc[-fwd_returns:]
+        df = df.drop(columns=['datetime','security','close']).dropna() # same columns as ml_preprocessing
+        buffer = BytesIO()
+        df.to_parquet(buffer,index=False,compression='snappy')
+        s3.put_object(Bucket=Bucket, Key=out_prefix+"security="+security+"/part-{:05d}.parquet".format(part), Body=buffer.getvalue())
+    os.remove(spill_file)
+    return security
+
+def ml_preprocessing_chunked(input_file,bucket="model-support-files",fwd_returns=5,chunksize=500000,processes=None):
+    """
+    out-of-core version of ml_preprocessing, memory is bounded by chunksize rows per process
+    args:
+        input_file: ml log key (csv, parquet or the prefix of an incremental log ending with /), type string
+        fwd_returns: number of bars of the returns, type integer
+        chunksize: rows read at once, type integer
+        processes: size of the process pool working on the securities, type integer
+    returns:
+        prefix of the partitioned output
+    """
+    s3 = s3_client()
+    Bucket=bucket
+    Key=input_file
+    out_prefix = "processed_"+Key.rstrip("/").replace(".parquet","").replace(".csv","")+"/"
+    tmp_dir = tempfile.mkdtemp(prefix="ml_preprocessing-")
+    writers = {}
+    try:
+        # split the log per security into local spill files, keeping the bar order
+        for df in iter_log_chunks(s3,Bucket,Key,chunksize,tmp_dir):
+            for security, sec_df in df.groupby("security", sort=False):
+                table = pa.Table.from_pandas(sec_df, preserve_index=False)
+                if security not in writers:
+                    writers[security] = pq.ParquetWriter(os.path.join(tmp_dir, security+".parquet"), table.schema)
+                writers[security].write_table(table)
+        for writer in writers.values():
+            writer.close()
+
+        with multiprocessing.get_context("spawn").Pool(processes) as pool: # pyarrow is not fork safe
+            pool.starmap(process_security, [(os.path.join(tmp_dir, security+".parquet"),security,Bucket,out_prefix,fwd_returns,chunksize) for security in writers])
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return out_prefix
@@ -0,0 +1,186 @@
+"""
+Local cache of the MLflow model artifacts stored in Minio.
+
+Entries are named by the run id and a hash of the artifact ETags at download time.
+A model with a local entry is loaded without contacting Minio, Minio is only listed
+on a miss (a model logged again under the same run id is not picked up until its
+entries are evicted or removed). The cache is shared by all the processes of a
+worker: downloads and evictions happen under an exclusive file lock, models are
+loaded under a shared one so that an entry is never evicted while it is read, and
+the least recently used entries are evicted once the cache grows over its size limit.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+
+import boto3
+import boto3.exceptions
+import botocore.exceptions
+import mlflow.pyfunc
+
+CACHE_DIR = os.environ.get("MODEL_CACHE_DIR", os.path.join(tempfile.gettempdir(), "mlflow-model-cache"))
+CACHE_MAX_MB = float(os.environ.get("MODEL_CACHE_MAX_MB", 2048))
+BUCKET = "mlflow-models"
+# errors of an artifact download: Minio client and transfer errors, local disk errors
+DOWNLOAD_ERRORS = (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError, boto3.exceptions.Boto3Error, OSError)
+LAST_USED = ".last_used"  # touched on every hit, its mtime orders the LRU
+
+
+@contextlib.contextmanager
+def cache_lock(cache_dir, shared=False):
+    """
+    lock on the cache directory, across processes
+    args:
+        cache_dir: cache directory, type string
+        shared: shared (read) lock instead of the exclusive one, type boolean
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def list_artifacts(s3, run_id, bucket=BUCKET):
+    """
+    list the model artifacts of a run in Minio
+    args:
+        s3: boto3 s3 client
+        run_id: mlflow run id, type string
+    returns:
+        list of (key, etag, size) tuples sorted by key
+    """
+    prefix = run_id + "/artifacts/model/"
+    objects = []
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            objects.append((obj["Key"], obj["ETag"], obj["Size"]))
+    return sorted(objects)
+
+
+def artifact_hash(objects):
+    """
+    content hash of the artifacts, built from their keys and ETags
+    """
+    digest = hashlib.sha1()
+    for key, etag, size in objects:
+        digest.update((key + etag).encode())
+    return digest.hexdigest()[:16]
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(path) for f in files)
+
+
+def evict(cache_dir, max_bytes, keep=None):
+    """
+    removes the least recently used entries until the cache fits in max_bytes.
+    Has to be called with the cache lock held
+    args:
+        cache_dir: cache directory, type string
+        max_bytes: size limit, type integer
+        keep: entry which is never evicted (the one being loaded), type string
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path) and not name.startswith("."):
+            marker = os.path.join(path, LAST_USED)
+            last_used = os.path.getmtime(marker) if os.path.exists(marker) else 0
+            entries.append((last_used, name, dir_size(path)))
+
+    total = sum(e[2] for e in entries)
+    for last_used, name, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if name == keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        total -= size
+
+
+def cached_entry(model_uri, cache_dir):
+    """
+    local entry of the model of a run, the most recently used one if there are several.
+    Has to be called with the cache lock held
+    returns:
+        local path to the model directory, None on a miss
+    """
+    paths = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.startswith(model_uri + "-")]
+    paths = [path for path in paths if os.path.isdir(path)]
+    if not paths:
+        return None
+    markers = [os.path.join(path, LAST_USED) for path in paths]
+    last_used, entry_path = max((os.path.getmtime(m) if os.path.exists(m) else 0, path) for m, path in zip(markers, paths))
+    marker = os.path.join(entry_path, LAST_USED)
+    open(marker, "a").close()
+    os.utime(marker, None)
+    return entry_path
+
+
+def fetch_model(model_uri, cache_dir=CACHE_DIR, max_mb=CACHE_MAX_MB, bucket=BUCKET):
+    """
+    returns the local path of the model of a run, downloading it from Minio on a miss.
+    The entry can be evicted once this returns, read it under the shared lock (see load_model)
+    args:
+        model_uri: mlflow run id of the model, type string
+        cache_dir: cache directory, type string
+        max_mb: cache size limit in MB, type float
+    returns:
+        local path to the model directory
+    """
+    with cache_lock(cache_dir):
+        entry_path = cached_entry(model_uri, cache_dir)
+        if entry_path is not None:
+            return entry_path
+
+        s3 = boto3.client('s3',endpoint_url="http://minio-image:9000",aws_access_key_id="minio-image",aws_secret_access_key="minio-image-pass")
+        objects = list_artifacts(s3, model_uri, bucket)
+        if not objects:
+            raise Exception('No model artifacts found for run {}'.format(model_uri))
+        entry = model_uri + "-" + artifact_hash(objects)
+        entry_path = os.path.join(cache_dir, entry)
+        prefix = model_uri + "/artifacts/model/"
+        tmp_path = tempfile.mkdtemp(prefix=".download-", dir=cache_dir)
+        try:
+            for key, etag, size in objects:
+                local_file = os.path.join(tmp_path, key[len(prefix):])
+                os.makedirs(os.path.dirname(local_file), exist_ok=True)
+                s3.download_file(bucket, key, local_file)
+            os.rename(tmp_path, entry_path)
+        except DOWNLOAD_ERRORS:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        print("Model", model_uri, "downloaded to cache", entry_path)
+
+        marker = os.path.join(entry_path, LAST_USED)
+        open(marker, "a").close()
+        os.utime(marker, None)
+        evict(cache_dir, max_mb * 1024 * 1024, keep=entry)
+    return entry_path
+
+
+def load_model(model_uri, **kwargs):
+    """
+    mlflow.pyfunc.load_model through the local cache
+    args:
+        model_uri: mlflow run id of the model, type string
+        kwargs: see fetch_model
+    returns:
+        mlflow pyfunc model
+    """
+    cache_dir = kwargs.get("cache_dir", CACHE_DIR)
+    for attempt in range(3):
+        # the shared lock keeps the entry from being evicted while it is read
+        with cache_lock(cache_dir, shared=True):
+            entry_path = cached_entry(model_uri, cache_dir)
+            if entry_path is not None:
+                return mlflow.pyfunc.load_model(entry_path)
+        fetch_model(model_uri, **kwargs)
+    raise Exception('Model of run {} evicted from the cache before it could be loaded, increase MODEL_CACHE_MAX_MB'.format(model_uri))
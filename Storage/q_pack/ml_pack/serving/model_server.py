@@ -0,0 +1,160 @@
+"""
+Local inference server shared by the strategies running on a worker.
+
+The server keeps each MLflow model loaded once and micro-batches the prediction
+requests of all connected strategy processes: requests arriving within
+max_wait seconds of each other are stacked into one predict call per model.
+
+Start it once per worker:
+    python ml_pack/serving/model_server.py --address /tmp/q_pack_model_server.sock
+
+and pass the address to the strategy (ml_server=<address>), which then uses a
+RemotePredictor in place of the locally loaded model.
+"""
+
+import argparse
+import collections
+import os
+import queue
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from ml_pack.serving import model_cache
+
+ADDRESS = os.environ.get("MODEL_SERVER_ADDRESS", os.path.join(tempfile.gettempdir(), "q_pack_model_server.sock"))
+
+
+class ModelServer(object):
+
+    def __init__(self, address=ADDRESS, max_batch=4096, max_wait=0.005):
+        self.address = address
+        self.max_batch = max_batch # rows
+        self.max_wait = max_wait # seconds to wait for more requests to batch
+        self.models = {}
+        self.models_lock = threading.Lock()
+        self.requests = queue.Queue()
+
+    def model(self, model_uri):
+        with self.models_lock:
+            if model_uri not in self.models:
+                self.models[model_uri] = model_cache.load_model(model_uri)
+                print("Model", model_uri, "loaded")
+            return self.models[model_uri]
+
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            os.remove(self.address) # stale socket of a previous server
+        listener = Listener(self.address, family='AF_UNIX')
+        t = threading.Thread(target=self._batcher)
+        t.daemon = True
+        t.start()
+        print("Model server listening on", self.address)
+        while True:
+            conn = listener.accept()
+            t = threading.Thread(target=self._client, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _client(self, conn):
+        # one thread per strategy process, requests of a client are sequential
+        reply = queue.Queue(maxsize=1)
+        try:
+            while True:
+                kind, model_uri, features = conn.recv()
+                if kind == 'load':
+                    try:
+                        self.model(model_uri)
+                        conn.send(None)
+                    except Exception as e:
+                        conn.send(e)
+                    continue
+                self.requests.put((model_uri, np.asarray(features, dtype=float), reply))
+                conn.send(reply.get())
+        except EOFError:
+            pass # client went away
+        finally:
+            conn.close()
+
+    def _batcher(self):
+        while True:
+            batch = [self.requests.get()]
+            rows = len(batch[0][1])
+            deadline = time.time() + self.max_wait
+            while rows < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                rows += len(request[1])
+
+            by_model = collections.defaultdict(list)
+            for request in batch:
+                by_model[request[0]].append(request)
+
+            for model_uri, requests in by_model.items():
+                try:
+                    features = np.vstack([features for _, features, _ in requests])
+                    preds = np.asarray(self.model(model_uri).predict(features)).ravel()
+                except Exception as e:
+                    for _, _, reply in requests:
+                        reply.put(e)
+                    continue
+                start = 0
+                for _, features, reply in requests:
+                    reply.put(preds[start:start + len(features)])
+                    start += len(features)
+
+
+class RemotePredictor(object):
+    """
+    client side of the model server, with the predict interface of the pyfunc models
+    """
+
+    def __init__(self, model_uri, address=ADDRESS):
+        self.model_uri = model_uri
+        self.conn = Client(address, family='AF_UNIX')
+        self._call('load', None) # fail early if the server cannot load the model
+
+    def _call(self, kind, features):
+        self.conn.send((kind, self.model_uri, features))
+        result = self.conn.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def predict(self, features):
+        return self._call('predict', np.asarray(features, dtype=float))
+
+    def close(self):
+        self.conn.close()
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=('Local MLflow model server for the strategies'),
+    )
+
+    parser.add_argument('--address', required=False, default=ADDRESS,
+                        help='Unix socket path to listen on')
+
+    parser.add_argument('--max_batch', required=False, default=4096, type=int,
+                        help='Maximum rows per batched predict call')
+
+    parser.add_argument('--max_wait', required=False, default=0.005, type=float,
+                        help='Seconds to wait for more requests before predicting')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    ModelServer(address=args.address, max_batch=args.max_batch, max_wait=args.max_wait).serve_forever()
@@ -0,0 +1,259 @@
+"""
+Checkpoints of a backtest, so that a later run extends it over the new bars only.
+
+At stop the analyzer saves in Minio (model-support-files/backtest-checkpoints/<name>.json):
+ - the broker cash and value, the positions and the open trades (with their history) of every data
+ - the orders still alive after the last bar, with their bracket parent, oco group, validity, price
+   limit and trailing settings, which the full run would have processed on the next bar
+ - the last bar of every data and the replay window of the strategy: the minimum period - 1 bars its
+   indicators need, plus the bars its recursive indicators (EMA, RSI, ATR, ...) need to converge,
+   and at least the checkpoint bar
+
+A run resumed from a checkpoint (run_BT --checkpoint=<name>) feeds every data from the start of its
+replay window. The minimum period of the strategy is raised to the replay window + 1 bar, so it is in
+prenext() up to the checkpoint bar and calls next() from the first new bar on. The broker, positions
+and trades are restored in start(), and the orders are submitted again at the checkpoint bar, with
+bracket children attached to their parent (or linked as oco once the parent executed).
+Indicators over a fixed window match the full run, recursive ones converge over the replay window to
+RECURSIVE_TOL. A strategy whose smoothing can't be bounded (dynamic alpha, e.g. KAMA) is refused.
+
+The analyzers with a running state (peak value, returns, trade counters) provide checkpoint_state() and
+restore_state(state). Their states are saved with the checkpoint and restored before the first new bar,
+replacing what they recorded over the replayed bars, so the metrics of the resumed run (under a new run_id)
+cover the whole backtest as a full run would. The checkpoint bar of every data is kept in
+strategy.checkpoint_datetimes for the analyzers which must not record the replayed bars at all (ml log).
+"""
+
+import array
+import base64
+import datetime
+import json
+import math
+import pickle
+
+import backtrader as bt
+import boto3
+from backtrader.trade import TradeHistory
+
+BUCKET = "model-support-files"
+PREFIX = "backtest-checkpoints/"
+RECURSIVE_TOL = 1e-10 # weight left to the seed of a recursive indicator at the end of the replay window
+
+
+def s3_client():
+    return boto3.client('s3',endpoint_url="http://minio-image:9000",aws_access_key_id="minio-image",aws_secret_access_key="minio-image-pass")
+
+
+def read_checkpoint(name):
+    # checkpoint dict, None if there is no checkpoint with that name yet
+    s3 = s3_client()
+    try:
+        body = s3.get_object(Bucket=BUCKET, Key=PREFIX + name + ".json")['Body'].read()
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(body)
+
+
+def write_checkpoint(name, checkpoint):
+    s3_client().put_object(Bucket=BUCKET, Key=PREFIX + name + ".json", Body=json.dumps(checkpoint, indent=1))
+
+
+def recursive_warmup(strategy, tol=RECURSIVE_TOL):
+    """
+    bars after its seed an exponential smoothing of the strategy needs to forget it (weight < tol)
+    returns:
+        number of bars, 0 without recursive indicators
+    """
+    bars, seen = 0, set()
+    todo = list(strategy._lineiterators[bt.LineIterator.IndType])
+    while todo:
+        ind = todo.pop()
+        if id(ind) in seen:
+            continue
+        seen.add(id(ind))
+        if isinstance(ind, bt.indicators.ExponentialSmoothingDynamic):
+            raise ValueError("the strategy can't be checkpointed: " + type(ind._owner).__name__ +
+                             " smooths with a dynamic alpha, its state can't be rebuilt from a bounded replay window")
+        if isinstance(ind, bt.indicators.ExponentialSmoothing) and 0.0 < ind.alpha < 1.0:
+            bars = max(bars, int(math.ceil(math.log(tol) / math.log(ind.alpha1))))
+        todo += getattr(ind, '_lineiterators', {}).get(bt.LineIterator.IndType, [])
+    return bars
+
+
+def order_state(broker, order, alive):
+    # order fields to submit it again, see checkpoint_analyzer.resubmit
+    parent = order.parent if order.parent is not None and order.parent.ref in alive else None
+    if order.parent is not None and parent is None:
+        group = 'bracket-%d' % order.parent.ref # children of an executed parent cancel each other
+    else:
+        group = 'oco-%d' % broker._ocos.get(order.ref, order.ref)
+    return {'ref': order.ref, 'size': order.executed.remsize, 'price': order.created.price,
+            'pricelimit': order.created.pricelimit, 'exectype': order.exectype, 'valid': order.valid,
+            'tradeid': order.tradeid, 'trailamount': order.trailamount, 'trailpercent': order.trailpercent,
+            'parent': parent.ref if parent is not None else None, 'group': group,
+            'accepted': order.status == order.Accepted}
+
+
+def plain(value):
+    # True for the values of a state that can be saved: numbers, strings, dates and containers of them
+    if isinstance(value, (bool, int, float, str, type(None), datetime.date, datetime.timedelta, array.array)):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(plain(v) for v in value)
+    if isinstance(value, dict):
+        return all(plain(k) and plain(v) for k, v in value.items())
+    return False
+
+
+def analyzer_state(analyzer):
+    # running state of a backtrader analyzer (and of its child analyzers): its attributes holding plain values
+    return (dict((k, v) for k, v in vars(analyzer).items() if plain(v)),
+            [analyzer_state(child) for child in analyzer._children])
+
+
+def restore_analyzer_state(analyzer, state):
+    attributes, children = state
+    vars(analyzer).update(attributes)
+    for child, child_state in zip(analyzer._children, children):
+        restore_analyzer_state(child, child_state)
+
+
+class checkpoint_analyzer(bt.Analyzer):
+    # must be added before the other analyzers, so that they start with the restored broker
+    params = (
+        ('name', ''), # checkpoint name
+        ('checkpoint', None), # checkpoint to resume from, see read_checkpoint
+        ('run', None), # run arguments stored with the checkpoint (strategy, parameters, tickers)
+    )
+
+    def get_analysis(self):
+        return self.checkpoint
+
+    def start(self):
+        self.checkpoint = None
+        self.states = None # analyzer states waiting for the end of the replay
+        self.resumed = [self.p.checkpoint is None] * len(self.datas)
+        self.orders, self.leaders = {}, {} # checkpoint order ref -> new order, group -> first order submitted
+        # replay window needed by the strategy, from its own minimum periods (before they are raised below)
+        self.warmup = [max(mp - 1 + recursive_warmup(self.strategy), 1) for mp in self.strategy._minperiods]
+        if self.p.checkpoint is None:
+            return
+        ckpt = self.p.checkpoint
+        if 'analyzers' not in ckpt or any('warmup_bars' not in cd for cd in ckpt['datas']):
+            raise ValueError("checkpoint " + self.p.name + " has no replay window nor analyzer states, run the backtest again without it")
+        self.states = pickle.loads(base64.b64decode(ckpt['analyzers']))
+        self.strategy.checkpoint_datetimes = [cd['datetime'] for cd in ckpt['datas']]
+        self.strategy.checkpoint_start = ckpt['start'] # start of the checkpointed backtest, see strategy_id_analyzer
+        for i, cd in enumerate(ckpt['datas']):
+            # next() only after the replayed bars, which end at the checkpoint bar
+            self.strategy._minperiods[i] = max(self.strategy._minperiods[i], cd['warmup_bars'] + 1)
+        self.strategy._minperiod = max(self.strategy._minperiods)
+        broker = self.strategy.broker
+        broker.set_cash(ckpt['cash'])
+        broker._value = ckpt['value'] # read by the analyzers at start, updated by the broker on the first bar
+        self.trades = []
+        for d, cd in zip(self.datas, ckpt['datas']):
+            pos = broker.positions[d]
+            pos.set(cd['position']['size'], cd['position']['price'])
+            if cd['position']['datetime'] is not None:
+                pos.datetime = bt.num2date(cd['position']['datetime'])
+            for ct in cd['trades']:
+                trade = bt.Trade(data=d, historyon=self.strategy._tradehistoryon, size=ct['size'], price=ct['price'],
+                                 value=ct['value'], commission=ct['commission'])
+                trade.pnl, trade.pnlcomm, trade.long, trade.dtopen = ct['pnl'], ct['pnlcomm'], ct['long'], ct['dtopen']
+                trade.isopen, trade.status = True, trade.Open
+                trade.restored_high, trade.restored_low = ct['high'], ct['low'] # extremes before the checkpoint
+                for h in ct['history']:
+                    entry = TradeHistory(h['status'], h['dt'], h['barlen'], h['size'], h['price'], h['value'], h['pnl'], h['pnlcomm'], d._tz)
+                    entry.doupdate(None, h['event_size'], h['event_price'], h['event_commission'])
+                    trade.history.append(entry)
+                self.strategy._trades[d][0].append(trade)
+                self.trades.append((d, trade, ct['bars_held']))
+
+    def end_replay(self, force=False):
+        # This analyzer is the first one notified, so the states are restored before the others see a new bar
+        if self.states is None or not (force or self.strategy.datetime[0] > max(self.strategy.checkpoint_datetimes)):
+            return
+        states, self.states = self.states, None
+        for name, analyzer in self.strategy.analyzers.getitems():
+            if name in states:
+                analyzer.restore_state(states[name])
+
+    def notify_order(self, order):
+        self.end_replay()
+
+    def notify_trade(self, trade):
+        self.end_replay()
+
+    def notify_cashvalue(self, cash, value):
+        self.end_replay()
+
+    def next(self):
+        # called from prenext too: at the checkpoint bar the full run was in the same state
+        self.end_replay()
+        for i, (d, cd) in enumerate(zip(self.datas, self.p.checkpoint['datas'] if self.p.checkpoint else [])):
+            if self.resumed[i] or not len(d) or d.datetime[0] < cd['datetime']:
+                continue
+            self.resumed[i] = True
+            for data, trade, bars_held in self.trades:
+                if data is d:
+                    trade.baropen = len(d) - bars_held
+            for co in cd['orders']:
+                self.resubmit(d, co, cd['orders'])
+
+    def resubmit(self, d, co, orders):
+        kwargs = dict(data=d, size=abs(co['size']), price=co['price'], plimit=co['pricelimit'], exectype=co['exectype'],
+                      valid=co['valid'], tradeid=co['tradeid'], trailamount=co['trailamount'], trailpercent=co['trailpercent'],
+                      _checksubmit=not co['accepted']) # accepted orders go straight back to the pending ones
+        if co['parent'] is not None:
+            # bracket with a pending parent: the last child transmits the bracket
+            siblings = [o['ref'] for o in orders if o['parent'] == co['parent']]
+            kwargs.update(parent=self.orders[co['parent']], transmit=co['ref'] == siblings[-1])
+        elif any(o['parent'] == co['ref'] for o in orders):
+            kwargs['transmit'] = False # held until its children are submitted
+        if co['group'] in self.leaders:
+            kwargs['oco'] = self.leaders[co['group']]
+        order = (self.strategy.buy if co['size'] > 0 else self.strategy.sell)(**kwargs)
+        self.orders[co['ref']] = order
+        self.leaders.setdefault(co['group'], order)
+
+    def stop(self):
+        self.end_replay(force=True) # no new bars
+        broker = self.strategy.broker
+        pending = [o for o in list(broker.submitted) + list(broker.pending) if o is not None and o.alive()]
+        alive = set(o.ref for o in pending)
+        datas = []
+        for d, warmup in zip(self.datas, self.warmup):
+            warmup = min(warmup, len(d))
+            pos = broker.getposition(d)
+            trades = []
+            for trade in self.strategy._trades[d][0]:
+                if not trade.isopen:
+                    continue
+                bars_held = len(d) - trade.baropen
+                window = min(bars_held + 1, len(d))
+                trades.append({'size': trade.size, 'price': trade.price, 'value': trade.value, 'commission': trade.commission,
+                               'pnl': trade.pnl, 'pnlcomm': trade.pnlcomm, 'long': trade.long, 'dtopen': trade.dtopen,
+                               'bars_held': bars_held,
+                               'high': max(list(d.high.get(size=window)) + [getattr(trade, 'restored_high', float('-inf'))]),
+                               'low': min(list(d.low.get(size=window)) + [getattr(trade, 'restored_low', float('inf'))]),
+                               'history': [{'status': h.status.status, 'dt': h.status.dt, 'barlen': h.status.barlen, 'size': h.status.size,
+                                            'price': h.status.price, 'value': h.status.value, 'pnl': h.status.pnl, 'pnlcomm': h.status.pnlcomm,
+                                            'event_size': h.event.size, 'event_price': h.event.price, 'event_commission': h.event.commission}
+                                           for h in trade.history]})
+            datas.append({'name': d._name,
+                          'datetime': d.datetime[0],
+                          # first bar of the replay window, which ends at the checkpoint bar
+                          'warmup_from': d.datetime[-(warmup - 1)], 'warmup_bars': warmup,
+                          'position': {'size': pos.size, 'price': pos.price,
+                                       'datetime': bt.date2num(pos.datetime) if getattr(pos, 'datetime', None) else None},
+                          'trades': trades,
+                          'orders': [order_state(broker, o, alive) for o in pending if o.data is d]})
+        # taken before the stop() of the other analyzers, which runs after this one
+        states = dict((name, analyzer.checkpoint_state())
+                      for name, analyzer in self.strategy.analyzers.getitems() if hasattr(analyzer, 'checkpoint_state'))
+        self.checkpoint = {'run': self.p.run, 'cash': broker.getcash(), 'value': broker.getvalue(), 'datas': datas,
+                           'start': self.p.checkpoint['start'] if self.p.checkpoint else self.strategy.data0.fromdate,
+                           'analyzers': base64.b64encode(pickle.dumps(states)).decode()}
+        write_checkpoint(self.p.name, self.checkpoint)
+        print("Checkpoint saved in Minio Bucket:", BUCKET, "as", PREFIX + self.p.name + ".json")
@@ -1,41 +1,174 @@
 import backtrader as bt
 import datetime
+import numpy as np
 import pandas as pd
 import os
+import queue
+import threading
+import time
 
 import boto3
-from io import StringIO
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import q_tools.s3_multipart as s3_multipart
+from io import BytesIO
+
+EPOCH_NUM = bt.date2num(datetime.datetime(1970, 1, 1)) # backtrader float date of the unix epoch
+
+
+def line_values(line, size):
+    # numpy view of the last size values of a line, same values as line.get(size=size) without the copy to a list
+    try:
+        end = line.idx + 1
+        return np.frombuffer(line.array, dtype=float)[end-size:end]
+    except TypeError: # the line is not backed by an array (qbuffer)
+        return np.asarray(line.get(size=size), dtype=float)
+
+
+def num2date_array(values, tz=None):
+    # vectorized data.num2date for a whole line
+    dates = pd.to_datetime((values - EPOCH_NUM) * 86400.0, unit='s').round('ms')
+    if tz is not None:
+        dates = dates.tz_localize('UTC').tz_convert(tz).tz_localize(None)
+    return dates
+
 
 class logger_analyzer(bt.Analyzer):
+    params = (
+        ('log_format', 'parquet'), # parquet or csv
+        ('chunk_rows', 100000), # rows per parquet row group / csv chunk
+        ('part_size', 8*1024*1024), # bytes buffered before a multipart upload part is sent
+        ('incremental', False), # capture every bar in next() and flush chunks while running, also for live runs
+        ('flush_freq', 3600), # seconds after which a partly filled chunk is flushed in incremental mode
+    )
 
     def get_analysis(self):
         return None
 
-    def stop(self):
-        ml_list=[]
-        data_size=len(self.data)
+    def start(self):
+        if not self.p.incremental:
+            return
+        indicators=self.strategy.getindicators()
         num_of_sec=len(self.datas)
-        if self.strategy.p.backtest:   
-            for i, d in enumerate(self.datas):
-                ml_dict={}
-                data_size=len(d)
-                ml_dict["security"]=[d._name]*data_size
-                ml_dict["datetime"]=[self.data.num2date(x) for x in d.datetime.get(size=data_size)]#self.data
-                ml_dict["open"]=d.open.get(size=data_size)
-                ml_dict["high"]=d.high.get(size=data_size)
-                ml_dict["low"]=d.low.get(size=data_size)
-                ml_dict["close"]=d.close.get(size=data_size)
-                # ml_dict["close"]=d.get(size=data_size)
-                num_of_indicators=int(len(self.strategy.getindicators())/len(self.strategy.datas))
-                for j in range(num_of_indicators):
-                    ml_dict[self.strategy.getindicators()[j*num_of_sec+i].aliased]=self.strategy.getindicators()[j*num_of_sec+i].get(size=data_size) # tested for 3 conditions , indicators >,<,= securities
-                ml_list.append(pd.DataFrame(ml_dict))  
-            ml_df = pd.concat(ml_list,axis=0)
+        num_of_indicators=int(len(indicators)/num_of_sec)
+        # lines to capture per data, same columns as the stop() log
+        self.columns=["datetime","open","high","low","close"]+[indicators[j*num_of_sec].aliased for j in range(num_of_indicators)]
+        self.capture_lines=[[d.datetime,d.open,d.high,d.low,d.close]+[indicators[j*num_of_sec+i].lines[0] for j in range(num_of_indicators)]
+                            for i, d in enumerate(self.datas)]
+        self.last_len=[0]*num_of_sec
+        # bars up to the checkpoint were logged by the checkpointed run (see bt_checkpoint_analyzer)
+        self.logged_to=getattr(self.strategy,'checkpoint_datetimes',[float('-inf')]*num_of_sec)
+        self.chunk_num=0
+        self.new_chunk()
+        self.flush_queue=queue.Queue(maxsize=2) # bounds the chunks waiting for upload
+        self.flush_thread=threading.Thread(target=self.t_flush)
+        self.flush_thread.daemon=True
+        self.flush_thread.start()
+
+    def new_chunk(self):
+        self.buffer=np.empty((self.p.chunk_rows,len(self.columns)))
+        self.buffer_sec=np.empty(self.p.chunk_rows,dtype=int)
+        self.buffer_rows=0
+        self.last_flush=time.time()
+
+    def next(self):
+        if not self.p.incremental:
+            return
+        for i, d in enumerate(self.datas):
+            if len(d)==self.last_len[i]:
+                continue # no new bar for this data
+            self.last_len[i]=len(d)
+            if d.datetime[0]<=self.logged_to[i]:
+                continue # replayed bar
+            self.buffer[self.buffer_rows]=[line[0] for line in self.capture_lines[i]]
+            self.buffer_sec[self.buffer_rows]=i
+            self.buffer_rows+=1
+            if self.buffer_rows==self.p.chunk_rows:
+                self.flush()
+        if self.buffer_rows and time.time()-self.last_flush>self.p.flush_freq:
+            self.flush()
+
+    def flush(self):
+        # hands the filled part of the buffer to the upload thread and starts a new chunk
+        self.flush_queue.put((self.chunk_num,self.buffer[:self.buffer_rows],self.buffer_sec[:self.buffer_rows]))
+        self.chunk_num+=1
+        self.new_chunk()
+
+    def t_flush(self):
+        s3 = boto3.client('s3',endpoint_url="http://minio-image:9000",aws_access_key_id="minio-image",aws_secret_access_key="minio-image-pass")
+        Bucket="model-support-files"
+        while True:
+            msg=self.flush_queue.get()
+            if msg is None:
+                break
+            chunk_num, values, sec = msg
+            ml_df=pd.DataFrame(values,columns=self.columns)
+            ml_df.insert(0,"security",np.array([d._name for d in self.datas],dtype=object)[sec])
+            ml_df["datetime"]=num2date_array(ml_df["datetime"].values,tz=self.data._tz)
+            # one object per chunk, the log of a run is the <run_id>_ml_log/ prefix
+            Key=str(self.strategy.db_run_id)+"_ml_log/part-{:05d}.".format(chunk_num)+self.p.log_format
+            try:
+                if self.p.log_format=='csv':
+                    Body=ml_df.to_csv(index=False)
+                else:
+                    buffer=BytesIO()
+                    ml_df.to_parquet(buffer,index=False,compression='snappy')
+                    Body=buffer.getvalue()
+                s3.put_object(Bucket=Bucket,Key=Key,Body=Body)
+            except Exception as e:
+                print("ML Log chunk",Key,"not saved:",e)
+
+    def log_chunk(self, i, d, indicators, start, end):
+        # ml log rows [start, end) of data d, built on views of the line arrays
+        num_of_sec=len(self.datas)
+        num_of_indicators=int(len(indicators)/num_of_sec)
+        data_size=len(d)
+        ml_dict={}
+        ml_dict["security"]=[d._name]*(end-start)
+        ml_dict["datetime"]=num2date_array(line_values(d.datetime,data_size)[start:end],tz=d._tz)
+        ml_dict["open"]=line_values(d.open,data_size)[start:end]
+        ml_dict["high"]=line_values(d.high,data_size)[start:end]
+        ml_dict["low"]=line_values(d.low,data_size)[start:end]
+        ml_dict["close"]=line_values(d.close,data_size)[start:end]
+        for j in range(num_of_indicators):
+            indicator=indicators[j*num_of_sec+i] # tested for 3 conditions , indicators >,<,= securities
+            ml_dict[indicator.aliased]=line_values(indicator.lines[0],data_size)[start:end]
+        return pd.DataFrame(ml_dict)
+
+    def stop(self):
+        if self.p.incremental:
+            if self.buffer_rows:
+                self.flush()
+            self.flush_queue.put(None)
+            self.flush_thread.join()
+            print("ML Log Saved in Minio Bucket: model-support-files as",str(self.strategy.db_run_id)+"_ml_log/",self.chunk_num,"chunks")
+        elif self.strategy.p.backtest:
+            indicators=self.strategy.getindicators()
             s3 = boto3.client('s3',endpoint_url="http://minio-image:9000",aws_access_key_id="minio-image",aws_secret_access_key="minio-image-pass")
             Bucket="model-support-files"
-            Key=str(self.strategy.db_run_id)+"_ml_log.csv"
-            csv_buffer = StringIO()
-            ml_df.to_csv(csv_buffer,index=False)
-            s3.put_object(Bucket=Bucket, Key=Key,Body=csv_buffer.getvalue())
+            Key=str(self.strategy.db_run_id)+"_ml_log."+self.p.log_format
+            # chunks are streamed to Minio as they are built, memory is bounded by chunk_rows and part_size
+            with s3_multipart.S3MultipartWriter(s3, Bucket, Key, part_size=self.p.part_size) as out:
+                writer=None
+                logged_to=getattr(self.strategy,'checkpoint_datetimes',[float('-inf')]*len(self.datas))
+                for i, d in enumerate(self.datas):
+                    # bars after the replayed ones of a run resumed from a checkpoint
+                    first=int(np.searchsorted(line_values(d.datetime,len(d)),logged_to[i],side='right'))
+                    for start in range(first,len(d),self.p.chunk_rows):
+                        ml_df=self.log_chunk(i,d,indicators,start,min(start+self.p.chunk_rows,len(d)))
+                        if self.p.log_format=='csv':
+                            out.write(ml_df.to_csv(index=False,header=writer is None))
+                            writer=True
+                        else:
+                            table=pa.Table.from_pandas(ml_df,preserve_index=False)
+                            if writer is None:
+                                writer=pq.ParquetWriter(out,table.schema,compression='snappy')
+                            writer.write_table(table)
+                if writer is None:
+                    out.abort()
+                    print("ML Log is empty, nothing saved")
+                    return
+                if self.p.log_format!='csv':
+                    writer.close()
             print("ML Log Saved in Minio Bucket:",Bucket,"as",Key)
-            
@@ -1,14 +1,31 @@
 ####
 # Important Note: If there's already an open position in the account during live trading, this will error out because we are recording round trip trades 
 ####
-import backtrader as bt
+import array
 import datetime
 
+import backtrader as bt
+import numpy as np
+
 import psycopg2
 import q_credentials.db_risk_cred as db_risk_cred
 import q_tools.write_to_db as write_to_db
 
+def window_extremes(data, size):
+    # highest high and lowest low of the last size bars, on views of the line buffers (no copy) unless
+    # they are bounded queues (exactbars)
+    high, low = data.high, data.low
+    if isinstance(high.array, array.array):
+        end = high.idx + 1
+        return float(np.frombuffer(high.array)[end-size:end].max()), float(np.frombuffer(low.array)[end-size:end].min())
+    return max(high.get(size=size)), min(low.get(size=size))
+
+
 class pos_performance_analyzer(bt.Analyzer):
+    # the closed trades are written to position_performance in batches of batch rows (and at stop)
+    params = (
+        ('batch', 1000),
+    )
 
     def get_analysis(self):
 
@@ -18,8 +35,23 @@ class pos_performance_analyzer(bt.Analyzer):
     def __init__(self):
 
         self.trades = []
+        self.rows = []
         self.cumprofit = 0.0
-        self.conn = psycopg2.connect(host=db_risk_cred.dbHost , database=db_risk_cred.dbName, user=db_risk_cred.dbUser, password=db_risk_cred.dbPWD)
+        self.conn = write_to_db.risk_db_conn()
+
+    def stop(self):
+        self.flush()
+
+    def checkpoint_state(self):
+        # see bt_checkpoint_analyzer, the rows are written by the run which closed the trades
+        return {'cumprofit': self.cumprofit}
+
+    def restore_state(self, state):
+        self.cumprofit = state['cumprofit']
+
+    def flush(self):
+        write_to_db.write_many_to_db(conn=self.conn, rows=self.rows, table='position_performance')
+        self.rows = []
 
     def notify_trade(self, trade):
 
@@ -45,14 +77,13 @@ class pos_performance_analyzer(bt.Analyzer):
             pbar = (pnl / barlen) if barlen else pnl # to avoid divide by 0 error
             self.cumprofit += pnl
 
-            size = value = 0.0
-            for record in trade.history:
-                if abs(size) < abs(record.status.size):
-                    size = record.status.size
-                    value = record.status.value
+            largest = max(trade.history, key=lambda record: abs(record.status.size))
+            size, value = largest.status.size, largest.status.value
 
-            highest_in_trade = max(trade.data.high.get(ago=0, size=barlen+1))
-            lowest_in_trade = min(trade.data.low.get(ago=0, size=barlen+1))
+            # a trade restored from a checkpoint (see bt_checkpoint_analyzer) started before the bars of this run
+            highest_in_trade, lowest_in_trade = window_extremes(trade.data, min(barlen+1, len(trade.data)))
+            highest_in_trade = max(highest_in_trade, getattr(trade, 'restored_high', float('-inf')))
+            lowest_in_trade = min(lowest_in_trade, getattr(trade, 'restored_low', float('inf')))
             hp = 100 * (highest_in_trade - pricein) / pricein
             lp = 100 * (lowest_in_trade - pricein) / pricein
             if dir == 'long':
@@ -69,5 +100,7 @@ class pos_performance_analyzer(bt.Analyzer):
                  'nbars': barlen, 'pnl_per_bar': round(pbar, 2),
                  'mfe_percentage': round(mfe, 2), 'mae_percentage': round(mae, 2)}
 
-            write_to_db.write_to_db(conn=self.conn, data_dict=analyzer_result, table='position_performance')  
+            self.rows.append(analyzer_result)
             self.trades.append(analyzer_result)
+            if len(self.rows) >= self.p.batch:
+                self.flush()
@@ -6,42 +6,92 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 
+import array
 import collections
 
 import backtrader as bt
+import numpy as np
 import psycopg2
 import q_credentials.db_risk_cred as db_risk_cred
 import q_tools.write_to_db as write_to_db
+import q_tools.perf_metrics as perf_metrics
+import q_analyzers.bt_checkpoint_analyzer as bt_checkpoint_analyzer
 import datetime
 
+# periods per year of the annualized return, as bt.analyzers.Returns
+TANN = {bt.TimeFrame.Days: 252.0, bt.TimeFrame.Weeks: 52.0, bt.TimeFrame.Months: 12.0, bt.TimeFrame.Years: 1.0}
+
 class strat_performance_analyzer(bt.Analyzer):
+    # lean: only the broker value of every bar and the pnl of the closed trades are recorded (in compact arrays)
+    # and the metrics are computed from them at stop, instead of running the backtrader analyzers on every bar
+    params = (
+        ('lean', False),
+    )
 
     def __init__(self):
         self.performance = {}
-        self.conn = psycopg2.connect(host=db_risk_cred.dbHost , database=db_risk_cred.dbName, user=db_risk_cred.dbUser, password=db_risk_cred.dbPWD)
+        self.conn = write_to_db.risk_db_conn()
+        if self.p.lean:
+            return
         self.analyzer_sharpe = bt.analyzers.SharpeRatio()
         self.analyzer_returns = bt.analyzers.Returns()
         self.analyzer_sqn = bt.analyzers.SQN()
         self.analyzer_drawdown = bt.analyzers.DrawDown()
         self.analyzer_tradeanalyzer = bt.analyzers.TradeAnalyzer()
 
+    def start(self):
+        if self.p.lean:
+            self.value_start = self.strategy.broker.getvalue()
+            self.values = array.array('d')
+            self.closed_pnl = array.array('d')
+            self.n_open = 0
+
+    def next(self):
+        if self.p.lean:
+            self.values.append(self.strategy.broker.getvalue())
+
+    def checkpoint_state(self):
+        # see bt_checkpoint_analyzer, the backtrader analyzers are the children of this one
+        if self.p.lean:
+            return {'value_start': self.value_start, 'values': self.values, 'closed_pnl': self.closed_pnl, 'n_open': self.n_open}
+        return bt_checkpoint_analyzer.analyzer_state(self)
+
+    def restore_state(self, state):
+        if self.p.lean:
+            vars(self).update(state)
+        else:
+            bt_checkpoint_analyzer.restore_analyzer_state(self, state)
+
+    def notify_trade(self, trade):
+        if not self.p.lean:
+            return
+        if trade.justopened:
+            self.n_open += 1
+        elif trade.status == trade.Closed:
+            self.n_open -= 1
+            self.closed_pnl.append(trade.pnlcomm)
+
     def stop(self):
         self.performance['run_id']=self.strategy.db_run_id
-        self.performance['total_open']=self.analyzer_tradeanalyzer.get_analysis().total.open
-        self.performance['total_closed'] = self.analyzer_tradeanalyzer.get_analysis().total.closed
-        self.performance['total_won'] = self.analyzer_tradeanalyzer.get_analysis().won.total
-        self.performance['total_lost'] = self.analyzer_tradeanalyzer.get_analysis().lost.total
-        self.performance['win_streak'] = self.analyzer_tradeanalyzer.get_analysis().streak.won.longest
-        self.performance['lose_streak'] = self.analyzer_tradeanalyzer.get_analysis().streak.lost.longest
-        self.performance['pnl_net'] = round(self.analyzer_tradeanalyzer.get_analysis().pnl.net.total,2)
-        self.performance['strike_rate'] = (self.performance['total_won'] / self.performance['total_closed']) * 100
-        self.performance['sqn']=self.analyzer_sqn.get_analysis()['sqn']
-        self.performance['total_compound_return']=self.analyzer_returns.get_analysis()['rtot']
-        self.performance['avg_return']=self.analyzer_returns.get_analysis()['ravg']
-        self.performance['annual_norm_return']=self.analyzer_returns.get_analysis()['rnorm100']
-        self.performance['max_draw_per']=self.analyzer_drawdown.get_analysis()['max']['drawdown']
-        self.performance['max_draw_val']=self.analyzer_drawdown.get_analysis()['max']['moneydown']
-        self.performance['max_draw_len']=self.analyzer_drawdown.get_analysis()['max']['len']
+        if self.p.lean:
+            self.performance.update(perf_metrics.performance(np.frombuffer(self.values), np.frombuffer(self.closed_pnl), self.n_open,
+                                                             self.value_start, tann=TANN.get(self.data._timeframe, 1.0)))
+        else:
+            self.performance['total_open']=self.analyzer_tradeanalyzer.get_analysis().total.open
+            self.performance['total_closed'] = self.analyzer_tradeanalyzer.get_analysis().total.closed
+            self.performance['total_won'] = self.analyzer_tradeanalyzer.get_analysis().won.total
+            self.performance['total_lost'] = self.analyzer_tradeanalyzer.get_analysis().lost.total
+            self.performance['win_streak'] = self.analyzer_tradeanalyzer.get_analysis().streak.won.longest
+            self.performance['lose_streak'] = self.analyzer_tradeanalyzer.get_analysis().streak.lost.longest
+            self.performance['pnl_net'] = round(self.analyzer_tradeanalyzer.get_analysis().pnl.net.total,2)
+            self.performance['strike_rate'] = (self.performance['total_won'] / self.performance['total_closed']) * 100
+            self.performance['sqn']=self.analyzer_sqn.get_analysis()['sqn']
+            self.performance['total_compound_return']=self.analyzer_returns.get_analysis()['rtot']
+            self.performance['avg_return']=self.analyzer_returns.get_analysis()['ravg']
+            self.performance['annual_norm_return']=self.analyzer_returns.get_analysis()['rnorm100']
+            self.performance['max_draw_per']=self.analyzer_drawdown.get_analysis()['max']['drawdown']
+            self.performance['max_draw_val']=self.analyzer_drawdown.get_analysis()['max']['moneydown']
+            self.performance['max_draw_len']=self.analyzer_drawdown.get_analysis()['max']['len']
 
         write_to_db.write_to_db(conn=self.conn, data_dict=self.performance, table='strategy_performance')
 
@@ -19,7 +19,7 @@ class strategy_id_analyzer(bt.Analyzer):
 
     def __init__(self):
         self.strat_info = {}
-        self.conn = psycopg2.connect(host=db_risk_cred.dbHost , database=db_risk_cred.dbName, user=db_risk_cred.dbUser, password=db_risk_cred.dbPWD)
+        self.conn = write_to_db.risk_db_conn()
         self.current_time=datetime.datetime.now()
 
     def get_analysis(self):
@@ -31,7 +31,8 @@ class strategy_id_analyzer(bt.Analyzer):
         info_indicators = ','.join([i.aliased for i in (self.strategy.getindicators())])
         info_timeframe = self.strategy.data0._timeframe # This is currently a number, have to change it later
         if self.strategy.p.backtest:
-            info_start_date =  bt.num2date(self.strategy.data0.fromdate) # would have to change for live due to the backfill.
+            # a run resumed from a checkpoint extends the checkpointed backtest, see bt_checkpoint_analyzer
+            info_start_date =  bt.num2date(getattr(self.strategy, 'checkpoint_start', self.strategy.data0.fromdate)) # would have to change for live due to the backfill.
             info_end_date =  bt.num2date(self.strategy.data0.todate)
         else:
             info_start_date =  self.current_time # would have to change for live due to the backfill.
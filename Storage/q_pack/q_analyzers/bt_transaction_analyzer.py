@@ -51,7 +51,7 @@ class transactions_analyzer(bt.Analyzer):
 
     def __init__(self):
         self.trades = []
-        self.conn = psycopg2.connect(host=db_risk_cred.dbHost , database=db_risk_cred.dbName, user=db_risk_cred.dbUser, password=db_risk_cred.dbPWD)
+        self.conn = write_to_db.risk_db_conn()
 
     def get_analysis(self):
         return self.trades
@@ -2,12 +2,168 @@
 #                         unicode_literals)
 
 import datetime
+import queue
+import threading
+import numpy as np
 from backtrader.feed import DataBase
-from backtrader import date2num
+from backtrader import date2num, TimeFrame
 from sqlalchemy import create_engine
 
+TABLES = ('daily_data', 'minute_data')
+
+# Bar filters, all optional (NULL): session windows as arrays of start and end times of day (a window
+# with start > end wraps around midnight, the end is excluded), ISO weekdays (1 Monday .. 7 Sunday)
+# and holiday dates. The same filters are applied to bars in memory by filter_bars.
+FILTER_SQL = (" and (${0} is null or exists (select 1 from unnest(${0}, ${1}) s(t0, t1) where case when t0 <= t1"
+              " then date_price::time >= t0 and date_price::time < t1 else date_price::time >= t0 or date_price::time < t1 end))"
+              " and (${2} is null or extract(isodow from date_price)::integer = ANY(${2}))"
+              " and (${3} is null or date_price::date <> ALL(${3}))")
+FILTER_TYPES = ", time[], time[], integer[], date[]"
+
+# per table statements, prepared once per DB connection (the pooled connections keep them)
+BARS_SQL = "PREPARE bars_{table} (integer, timestamp, timestamp" + FILTER_TYPES + ") AS select date_price, open_price, high_price, low_price, close_price from {table} where stock_id = $1 and date_price between $2 and $3" + FILTER_SQL.format(4, 5, 6, 7) + " order by date_price ASC"
+# page of at most $4 bars after $2 (keyset pagination on date_price)
+BARS_PAGE_SQL = "PREPARE bars_page_{table} (integer, timestamp, timestamp, integer" + FILTER_TYPES + ") AS select date_price, open_price, high_price, low_price, close_price from {table} where stock_id = $1 and date_price > $2 and date_price <= $3" + FILTER_SQL.format(5, 6, 7, 8) + " order by date_price ASC limit $4"
+UNIVERSE_SQL = "PREPARE universe_{table} (integer[], timestamp, timestamp" + FILTER_TYPES + ") AS select stock_id, date_price, open_price, high_price, low_price, close_price from {table} where stock_id = ANY($1) and date_price between $2 and $3" + FILTER_SQL.format(4, 5, 6, 7) + " order by stock_id, date_price ASC"
+
+_ENGINES = {} # url -> engine, shared by all the feeds of the process
+_SYMBOL_IDS = {} # (url, ticker) -> symbol id
+
+
+def get_engine(dbHost, dbUser, dbPWD, dbName):
+    url = 'postgresql+psycopg2://'+dbUser+':'+ dbPWD +'@'+ dbHost +'/'+ dbName
+    if url not in _ENGINES:
+        _ENGINES[url] = create_engine(url)
+    return _ENGINES[url]
+
+
+def symbol_ids(conn, tickers):
+    """
+    symbol ids of tickers, looked up once per database and cached
+    args:
+        conn: SQLAlchemy connection of the securities master
+        tickers: type list of strings
+    returns:
+        dict of ticker -> symbol id, without the tickers missing from the symbol table
+    """
+    url = str(conn.engine.url)
+    missing = [t for t in tickers if (url, t) not in _SYMBOL_IDS]
+    if missing:
+        for symbol_id, ticker in conn.execute("select id, ticker from symbol where ticker = ANY(%(tickers)s)", tickers=missing):
+            _SYMBOL_IDS[(url, ticker)] = symbol_id
+    return dict((t, _SYMBOL_IDS[(url, t)]) for t in tickers if (url, t) in _SYMBOL_IDS)
+
+
+def execute_prepared(conn, statement, table, params):
+    """
+    executes the statement (BARS_SQL, BARS_PAGE_SQL or UNIVERSE_SQL) of a table, preparing it first if this DB connection hasn't yet
+    returns:
+        result proxy
+    """
+    if table not in TABLES:
+        raise ValueError("unknown bar table " + table)
+    name = statement.split()[1].format(table=table)
+    prepared = conn.connection.info.setdefault('prepared', set()) # lives as long as the DB connection
+    if name not in prepared:
+        conn.execute(statement.format(table=table))
+        prepared.add(name)
+    # one parameter set in a list: a bare tuple starting with a list (the ids of UNIVERSE_SQL) is taken as executemany
+    return conn.execute("EXECUTE " + name + " (" + ", ".join(["%s"]*len(params)) + ")", [tuple(params)])
+
+
+def bars_table(timeframe=None):
+    # table of the bars of a timeframe, minute_data for minutes and below, daily_data otherwise
+    return 'minute_data' if timeframe is not None and timeframe <= TimeFrame.Minutes else 'daily_data'
+
+
+def date_params(fromdate, todate):
+    # zero padded, strftime gives '1-01-01' for datetime.min
+    return "%04d-%02d-%02d" % (fromdate.year, fromdate.month, fromdate.day), "%04d-%02d-%02d" % (todate.year, todate.month, todate.day)
+
+
+def to_time(t):
+    return datetime.datetime.strptime(t, "%H:%M").time() if isinstance(t, str) else t
+
+
+def to_date(d):
+    return datetime.datetime.strptime(d, "%Y-%m-%d").date() if isinstance(d, str) else d
+
+
+def filter_params(sessions=None, weekdays=None, holidays=None):
+    """
+    query parameters of FILTER_SQL
+    args:
+        sessions: (start, end) times of day ("HH:MM" or time) of the bars to keep, in the time of date_price, type list
+        weekdays: ISO weekdays of the bars to keep, type list of integers
+        holidays: dates ("YYYY-MM-DD" or date) of the bars to drop, type list
+    returns:
+        tuple of 4 query parameters, None for the filters not used
+    """
+    return (None if sessions is None else [to_time(s[0]) for s in sessions],
+            None if sessions is None else [to_time(s[1]) for s in sessions],
+            None if weekdays is None else [int(w) for w in weekdays],
+            None if holidays is None else [to_date(d) for d in holidays])
+
+
+def filter_bars(bars, sessions=None, weekdays=None, holidays=None):
+    """
+    the bars (dict of arrays, datetime as backtrader float dates) passing the filters of filter_params,
+    the same bars the filtered queries return
+    """
+    if sessions is None and weekdays is None and holidays is None:
+        return bars
+    dt = bars['datetime']
+    day = np.floor(dt).astype(int) # proleptic gregorian ordinal, as date.toordinal()
+    keep = np.ones(len(dt), dtype=bool)
+    if sessions is not None:
+        seconds = np.round((dt - day) * 86400.0)
+        in_session = np.zeros(len(dt), dtype=bool)
+        for start, end in sessions:
+            t0, t1 = [t.hour*3600 + t.minute*60 + t.second for t in (to_time(start), to_time(end))]
+            in_session |= ((seconds >= t0) & (seconds < t1)) if t0 <= t1 else ((seconds >= t0) | (seconds < t1))
+        keep &= in_session
+    if weekdays is not None:
+        keep &= np.isin((day - 1) % 7 + 1, [int(w) for w in weekdays])
+    if holidays is not None:
+        keep &= ~np.isin(day, [to_date(d).toordinal() for d in holidays])
+    return dict((col, values[keep]) for col, values in bars.items())
+
+
+def load_universe(engine, tickers, fromdate=datetime.datetime.min, todate=datetime.datetime.max, table='daily_data', **filters):
+    """
+    bars of several tickers with one query, split per ticker in memory, to be fed through Memory_Bars
+    args:
+        engine: SQLAlchemy engine of the securities master
+        tickers: type list of strings
+        fromdate, todate: date range (inclusive), type datetime
+        table: daily_data or minute_data, type string
+        filters: sessions, weekdays, holidays as in filter_params, evaluated in the query
+    returns:
+        dict of ticker -> dict of numpy arrays (datetime as backtrader float dates, open, high, low, close),
+        empty arrays for the tickers without bars
+    """
+    with engine.connect() as conn:
+        ids = symbol_ids(conn, list(tickers))
+        rows = execute_prepared(conn, UNIVERSE_SQL, table, (list(ids.values()),) + date_params(fromdate, todate) + filter_params(**filters)).fetchall()
+    stock_ids = np.array([r[0] for r in rows], dtype=int)
+    values = np.array([[date2num(r[1])] + [r[i] for i in range(2, 6)] for r in rows], dtype=float).reshape(-1, 5)
+    # rows are ordered by stock id, each ticker is one contiguous block
+    starts = np.flatnonzero(np.concatenate([[True], stock_ids[1:] != stock_ids[:-1]])) if len(stock_ids) else np.array([], dtype=int)
+    blocks = dict(zip(stock_ids[starts], np.split(values, starts[1:])))
+    empty = np.empty((0, 5))
+    return dict((ticker, dict((col, blocks.get(ids.get(ticker), empty)[:, j].copy()) for j, col in enumerate(['datetime', 'open', 'high', 'low', 'close'])))
+                for ticker in tickers)
+
+
+def load_bars(engine, ticker, fromdate=datetime.datetime.min, todate=datetime.datetime.max, table='daily_data', **filters):
+    # bars of one ticker, see load_universe
+    return load_universe(engine, [ticker], fromdate, todate, table, **filters)[ticker]
+
+
+class PostgreSQL_Bars(DataBase):
+    # bars of a ticker read from the table of the class (daily_data or minute_data) of the securities master
+    table = None
 
-class PostgreSQL_Daily(DataBase):
     params = (
         ('dbHost', None),
         ('dbUser', None),
@@ -17,24 +173,93 @@ class PostgreSQL_Daily(DataBase):
         ('fromdate', datetime.datetime.min),
         ('todate', datetime.datetime.max),
         ('name', ''),
+        ('chunk_rows', 0), # 0 reads all the bars with one query, else pages of chunk_rows bars
+        ('prefetch', False), # read the next pages in a background thread while the current one is processed
+        ('sessions', None), # (start, end) times of day of the bars to keep, e.g. [('12:00', '16:00')], filtered in the query
+        ('weekdays', None), # ISO weekdays of the bars to keep, e.g. [1, 2, 3, 4, 5]
+        ('holidays', None), # dates of the bars to drop, e.g. ['2019-12-25']
         )
 
     def __init__(self):
-        self.engine = create_engine('postgresql+psycopg2://'+self.p.dbUser+':'+ self.p.dbPWD +'@'+ self.p.dbHost +'/'+ self.p.dbName)
-#         self.engine = psycopg2.connect(host=self.p.dbHost, database=self.p.dbName, user=self.p.dbUser, password=self.p.dbPWD)
+        self.engine = get_engine(self.p.dbHost, self.p.dbUser, self.p.dbPWD, self.p.dbName)
 
     def start(self):
+        super(PostgreSQL_Bars, self).start()
         self.conn = self.engine.connect()
-        sql = "select a.date_price date, a.close_price as close, a.high_price high, a.open_price open, a.low_price low from daily_data a inner join symbol b on a.stock_id = b.id where b.ticker='"+ self.p.ticker + "' and a.date_price between '"+self.p.fromdate.strftime("%Y-%m-%d")+"' and '"+self.p.todate.strftime("%Y-%m-%d")+"' order by date ASC"
-        self.result = self.conn.execute(sql)
-        
+        ids = symbol_ids(self.conn, [self.p.ticker])
+        # a ticker missing from symbol gives no bars, as the join did
+        self.stock_id = ids.get(self.p.ticker, -1)
+        fromdate, todate = date_params(self.p.fromdate, self.p.todate)
+        self.filters = filter_params(self.p.sessions, self.p.weekdays, self.p.holidays)
+        if not self.p.chunk_rows and not self.p.prefetch:
+            self.result = execute_prepared(self.conn, BARS_SQL, self.table, (self.stock_id, fromdate, todate) + self.filters)
+            return
+        self.chunk_rows = self.p.chunk_rows or 50000
+        # pages start after the last bar read, the first one at the day of fromdate (1 microsecond before it, as date_price > $2)
+        first_day = datetime.datetime(self.p.fromdate.year, self.p.fromdate.month, self.p.fromdate.day)
+        self.page_after = first_day - datetime.timedelta(microseconds=1) if first_day > datetime.datetime.min else datetime.datetime.min
+        self.page_to = todate
+        self.chunk, self.chunk_idx, self.done = [], 0, False
+        if self.p.prefetch:
+            self.chunks = queue.Queue(maxsize=2) # double buffer: the page being read and the next one
+            self.stopping = False
+            self.prefetch_thread = threading.Thread(target=self.t_prefetch)
+            self.prefetch_thread.daemon = True
+            self.prefetch_thread.start()
+
+    def fetch_page(self):
+        rows = execute_prepared(self.conn, BARS_PAGE_SQL, self.table, (self.stock_id, self.page_after, self.page_to, self.chunk_rows) + self.filters).fetchall()
+        if rows:
+            self.page_after = rows[-1][0]
+        return rows
+
+    def put_chunk(self, rows):
+        # waits for room in the queue until the feed is stopped, so that stop() never waits on a full queue
+        while not self.stopping:
+            try:
+                self.chunks.put(rows, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def t_prefetch(self):
+        while not self.stopping:
+            try:
+                rows = self.fetch_page()
+            except Exception as e:
+                rows = e # raised again by _load
+            if not self.put_chunk(rows):
+                return
+            if not isinstance(rows, list) or len(rows) < self.chunk_rows:
+                break # last page
+        self.put_chunk([])
 
     def stop(self):
-        #self.conn.close()
-        self.engine.dispose()
+        if self.p.prefetch:
+            self.stopping = True
+            self.prefetch_thread.join()
+        self.conn.close() # back to the pool of the shared engine, with its prepared statements
+
+    def next_row(self):
+        if self.done:
+            return None
+        if self.chunk_idx == len(self.chunk):
+            self.chunk = self.chunks.get() if self.p.prefetch else self.fetch_page()
+            self.chunk_idx = 0
+            if isinstance(self.chunk, Exception):
+                raise self.chunk
+            if not self.chunk:
+                self.done = True
+                return None
+        self.chunk_idx += 1
+        return self.chunk[self.chunk_idx - 1]
 
     def _load(self):
-        one_row = self.result.fetchone()
+        if self.p.chunk_rows or self.p.prefetch:
+            one_row = self.next_row()
+        else:
+            one_row = self.result.fetchone()
         if one_row is None:
             return False
         self.lines.datetime[0] = date2num(one_row[0])
@@ -45,43 +270,41 @@ class PostgreSQL_Daily(DataBase):
 #         self.lines.volume[0] = int(one_row[5])
         self.lines.openinterest[0] = -1
         return True
-    
-class PostgreSQL_Minute(DataBase):
+
+
+class PostgreSQL_Daily(PostgreSQL_Bars):
+    table = 'daily_data'
+
+
+class PostgreSQL_Minute(PostgreSQL_Bars):
+    table = 'minute_data'
+
+
+class Memory_Bars(DataBase):
+    # Feeds bars already in memory (see load_bars), several cerebros can share the same arrays
     params = (
-        ('dbHost', None),
-        ('dbUser', None),
-        ('dbPWD', None),
-        ('dbName', None),
-        ('ticker', 'EUR_USD'),
+        ('bars', None),
         ('fromdate', datetime.datetime.min),
         ('todate', datetime.datetime.max),
         ('name', ''),
+        ('sessions', None), # filters as in PostgreSQL_Bars, see filter_bars
+        ('weekdays', None),
+        ('holidays', None),
         )
 
-    def __init__(self):
-        self.engine = create_engine('postgresql+psycopg2://'+self.p.dbUser+':'+ self.p.dbPWD +'@'+ self.p.dbHost +'/'+ self.p.dbName)
-        print(self.engine)
-#         self.engine = psycopg2.connect(host=self.p.dbHost, database=self.p.dbName, user=self.p.dbUser, password=self.p.dbPWD)
-
     def start(self):
-        self.conn = self.engine.connect()
-        sql = "select a.date_price date, a.close_price as close, a.high_price high, a.open_price open, a.low_price low from minute_data a inner join symbol b on a.stock_id = b.id where b.ticker='"+ self.p.ticker + "' and a.date_price between '"+self.p.fromdate.strftime("%Y-%m-%d")+"' and '"+self.p.todate.strftime("%Y-%m-%d")+"' order by date ASC"
-        self.result = self.conn.execute(sql)
-        
-
-    def stop(self):
-        #self.conn.close()
-        self.engine.dispose()
+        super(Memory_Bars, self).start()
+        self.bars = filter_bars(self.p.bars, self.p.sessions, self.p.weekdays, self.p.holidays)
+        self.idx = 0
 
     def _load(self):
-        one_row = self.result.fetchone()
-        if one_row is None:
+        if self.idx >= len(self.bars['datetime']):
             return False
-        self.lines.datetime[0] = date2num(one_row[0])
-        self.lines.open[0] = float(one_row[1])
-        self.lines.high[0] = float(one_row[2])
-        self.lines.low[0] = float(one_row[3])
-        self.lines.close[0] = float(one_row[4])
-#         self.lines.volume[0] = int(one_row[5])
+        self.lines.datetime[0] = self.bars['datetime'][self.idx]
+        self.lines.open[0] = self.bars['open'][self.idx]
+        self.lines.high[0] = self.bars['high'][self.idx]
+        self.lines.low[0] = self.bars['low'][self.idx]
+        self.lines.close[0] = self.bars['close'][self.idx]
         self.lines.openinterest[0] = -1
-        return True
\ No newline at end of file
+        self.idx += 1
+        return True
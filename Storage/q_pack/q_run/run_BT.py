@@ -17,18 +17,15 @@ import q_analyzers.bt_pos_perform_analyzer as bt_pos_performance_analyzer
 import q_analyzers.bt_transaction_analyzer as bt_trans_analyzer
 import q_analyzers.bt_strategy_id_analyzer as bt_strategy_id_analyzer
 import q_analyzers.bt_logger_analyzer as bt_logger_analyzer
+import q_analyzers.bt_checkpoint_analyzer as bt_checkpoint_analyzer
 import q_tools.args_parse_other as args_parse_other
+import q_tools.backtest_cache as backtest_cache
+import q_tools.write_to_db as write_to_db
 
-def run(args=None): 
-    args = parse_args(args)
-
-    cerebro = bt.Cerebro()
-
+def data_kwargs(args):
     # Data feed kwargs
     dkwargs = dict(**eval('dict(' + args.dargs + ')'))
 
-    ticker_list=args.tickers[0].split(',')
-
     dtfmt, tmfmt = '%Y-%m-%d', 'T%H:%M:%S'
     if args.fromdate:
         fmt = dtfmt + tmfmt * ('T' in args.fromdate)
@@ -37,14 +34,55 @@ def run(args=None):
     if args.todate:
         fmt = dtfmt + tmfmt * ('T' in args.todate)
         dkwargs['todate'] = datetime.datetime.strptime(args.todate, fmt)
+    return dkwargs
+
+
+def checkpoint_run(args):
+    # arguments a checkpoint must have been saved with to be resumed
+    return {'strat_name': args.strat_name, 'strat_param': dict((str(k), str(v)) for k, v in args.strat_param.items()),
+            'tickers': args.tickers[0], 'dargs': args.dargs, 'cash': args.cash}
+
+
+def run(args=None, bars=None):
+    # bars: optional dict of ticker -> bars already loaded with bt_datafeed_postgres.load_universe (see run_BT_batch)
+    args = parse_args(args)
+
+    cerebro = bt.Cerebro()
+
+    dkwargs = data_kwargs(args)
+
+    ticker_list=args.tickers[0].split(',')
+
+    checkpoint = None
+    if args.mode=='backtest' and args.checkpoint:
+        # resume from the checkpoint of the same backtest, over the replay window and the new bars
+        checkpoint = bt_checkpoint_analyzer.read_checkpoint(args.checkpoint)
+        if checkpoint is not None and checkpoint['run'] != checkpoint_run(args):
+            raise ValueError("checkpoint " + args.checkpoint + " is from another backtest: " + str(checkpoint['run']))
+        # the checkpoint analyzer restores the broker and the analyzer states, the other analyzers must start and be notified after it
+        cerebro.addanalyzer(bt_checkpoint_analyzer.checkpoint_analyzer,_name='checkpoint',name=args.checkpoint,checkpoint=checkpoint,run=checkpoint_run(args))
+
+    key = None
+    if args.mode=='backtest' and args.use_cache and not args.plot and not args.checkpoint:
+        # same strategy code, parameters and bars as a stored run: return its result instead of running again
+        engine = bt_datafeed_postgres.get_engine(db_cred.dbHost, db_cred.dbUser, db_cred.dbPWD, db_cred.dbName)
+        fingerprint = backtest_cache.data_fingerprint(engine, ticker_list, dkwargs.get('fromdate', datetime.datetime.min), dkwargs.get('todate', datetime.datetime.max),
+                                                      table=bt_datafeed_postgres.bars_table(dkwargs.get('timeframe')))
+        key = backtest_cache.cache_key(args, fingerprint)
+        hit = backtest_cache.lookup(write_to_db.risk_db_conn(), key)
+        if hit is not None:
+            run_id, pnl, performance = hit
+            print("Cached result of Run ID:", run_id, performance)
+            print('Profit ... or Loss: {:.2f}'.format(pnl))
+            return pnl
 
     cerebro.addanalyzer(bt_trans_analyzer.transactions_analyzer,_name='position_list')
     cerebro.addanalyzer(bt_strategy_id_analyzer.strategy_id_analyzer,_name='strategy_id')
-    cerebro.addanalyzer(bt_strat_performance_analyzer.strat_performance_analyzer,_name='strat_perf')
-    cerebro.addanalyzer(bt_pos_performance_analyzer.pos_performance_analyzer,_name='pos_perf')
+    cerebro.addanalyzer(bt_strat_performance_analyzer.strat_performance_analyzer,_name='strat_perf',lean=args.lean_perf)
+    cerebro.addanalyzer(bt_pos_performance_analyzer.pos_performance_analyzer,_name='pos_perf',batch=1 if args.mode=='live' else 1000)
     
     if args.ml_log:
-        cerebro.addanalyzer(bt_logger_analyzer.logger_analyzer,_name='ml_logger')
+        cerebro.addanalyzer(bt_logger_analyzer.logger_analyzer,_name='ml_logger',incremental=args.ml_log_incremental)
 
     if args.mode=='live':
         oandastore = btoandav20.stores.OandaV20Store(token=args.broker_token, account=args.broker_account, practice=True)
@@ -55,9 +93,30 @@ def run(args=None):
         cerebro.addstrategy(globals()[args.strat_name].St, backtest=False)
 
     elif args.mode=='backtest':
-
-        for ticker in ticker_list:
-            data = bt_datafeed_postgres.PostgreSQL_Daily(dbHost=db_cred.dbHost,dbUser=db_cred.dbUser,dbPWD=db_cred.dbPWD,dbName=db_cred.dbName,ticker=ticker, name=ticker,**dkwargs)
+        # --dargs chunk_rows=N and/or prefetch=True stream the bars of every ticker from the DB in pages while the strategy runs
+        stream = dict((k, dkwargs.pop(k)) for k in ('chunk_rows', 'prefetch') if k in dkwargs)
+        streamed = bars is None and any(stream.values())
+        table = bt_datafeed_postgres.bars_table(dkwargs.get('timeframe'))
+
+        if bars is None and not streamed:
+            # all the tickers with one query on one connection
+            engine = bt_datafeed_postgres.get_engine(db_cred.dbHost, db_cred.dbUser, db_cred.dbPWD, db_cred.dbName)
+            # session filters of --dargs (sessions, weekdays, holidays) are evaluated in the query
+            filters = dict((k, dkwargs[k]) for k in ('sessions', 'weekdays', 'holidays') if k in dkwargs)
+            fromdate = dkwargs.get('fromdate', datetime.datetime.min)
+            if checkpoint is not None:
+                fromdate = bt.num2date(min(cd['warmup_from'] for cd in checkpoint['datas']))
+            bars = bt_datafeed_postgres.load_universe(engine, ticker_list, fromdate, dkwargs.get('todate', datetime.datetime.max),
+                                                      table=table, **filters)
+        feed = bt_datafeed_postgres.PostgreSQL_Minute if table == 'minute_data' else bt_datafeed_postgres.PostgreSQL_Daily
+        for i, ticker in enumerate(ticker_list):
+            if checkpoint is not None:
+                dkwargs['fromdate'] = bt.num2date(checkpoint['datas'][i]['warmup_from'])
+            if streamed:
+                data = feed(dbHost=db_cred.dbHost, dbUser=db_cred.dbUser, dbPWD=db_cred.dbPWD, dbName=db_cred.dbName,
+                            ticker=ticker, name=ticker, **dict(dkwargs, **stream))
+            else:
+                data = bt_datafeed_postgres.Memory_Bars(bars=bars[ticker], name=ticker,**dkwargs)
             cerebro.adddata(data)
         cerebro.broker.setcash(args.cash)
         cerebro.addstrategy(globals()[args.strat_name].St, **args.strat_param)
@@ -72,9 +131,13 @@ def run(args=None):
     pnl = cerebro.broker.get_value() - args.cash
     print('Profit ... or Loss: {:.2f}'.format(pnl))
 
+    if key is not None:
+        backtest_cache.store(write_to_db.risk_db_conn(), key, results[0].db_run_id, pnl)
+
     strats = results
     if args.plot:
         cerebro.plot(style='candlestick',iplot=False,volume=False)
+    return pnl
    
 
 
@@ -88,7 +151,7 @@ def parse_args(pargs=None):
                         help='Pass the tickers with space')
 
     parser.add_argument('--dargs', default='',
-                        metavar='kwargs', help='kwargs in k1=v1,k2=v2 format')
+                        metavar='kwargs', help='kwargs in k1=v1,k2=v2 format, chunk_rows=N,prefetch=True to read the bars in pages while running')
 
     parser.add_argument('--fromdate', required=False, default='2010-1-1',
                         help='Date[time] in YYYY-MM-DD[THH:MM:SS] format')
@@ -111,6 +174,18 @@ def parse_args(pargs=None):
     parser.add_argument('--ml_log', required=False, default=False, type=args_parse_other.str2bool, const=True, nargs='?',
                         help='To save ML log or not')
     
+    parser.add_argument('--ml_log_incremental', required=False, default=False, type=args_parse_other.str2bool, const=True, nargs='?',
+                        help='Capture the ML log bar by bar and save it in chunks while running (works for live runs)')
+
+    parser.add_argument('--lean_perf', required=False, default=False, type=args_parse_other.str2bool, const=True, nargs='?',
+                        help='Compute the strategy performance from the equity curve and the closed trades at the end (faster on minute bars)')
+
+    parser.add_argument('--use_cache', required=False, default=False, type=args_parse_other.str2bool, const=True, nargs='?',
+                        help='Return the stored result of an identical backtest (same strategy code, parameters and data)')
+
+    parser.add_argument('--checkpoint', required=False, default='',
+                        help='Checkpoint name: resume the backtest from it if it exists, and save it at the end')
+
     parser.add_argument('--mode', required=False, default='backtest',   
                         help='Live or Backtest')
 
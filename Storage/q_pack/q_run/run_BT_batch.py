@@ -0,0 +1,139 @@
+"""
+Runs all the backtest rows of the strategy sheet (airflow-files/strategy.csv) as one job.
+
+The bars of every distinct (ticker, fromdate, todate, table) are read once from the securities master
+before the worker pool is forked, so the workers share them (copy on write) instead of each run
+querying the database again. Every worker process writes its results through one risk_db
+connection (write_to_db.risk_db_conn) for all the runs it executes.
+Live rows are skipped, they keep running from the dynamic DAG.
+
+Sample usage
+    python run_BT_batch.py --processes=4
+    python run_BT_batch.py --strategy_file=/tmp/strategy.csv
+"""
+
+import argparse
+import multiprocessing
+import sys
+import time
+import traceback
+
+import boto3
+import pandas as pd
+
+import q_run.run_BT as run_BT
+import q_datafeeds.bt_datafeed_postgres as bt_datafeed_postgres
+import q_credentials.db_secmaster_cred as db_cred
+
+# (ticker, fromdate, todate, table) -> bars, filled before the pool is forked and read by the workers
+_BARS = {}
+
+
+def read_strategy_sheet(strategy_file=""):
+    if strategy_file:
+        df = pd.read_csv(strategy_file, sep=',')
+    else:
+        s3 = boto3.client('s3',endpoint_url="http://minio-image:9000",aws_access_key_id="minio-image",aws_secret_access_key="minio-image-pass")
+        read_file = s3.get_object(Bucket="airflow-files", Key="strategy.csv")
+        df = pd.read_csv(read_file['Body'],sep=',')
+    df.fillna('', inplace=True)
+    return df
+
+
+def strategy_argv(row):
+    # run_BT arguments of a strategy sheet row, same as the command of the dynamic DAG
+    command={}
+    command['--strat_name']=row['Strategy']
+    command['--mode']=str(row['Mode'])
+    command['--tickers']=row['Securities']
+    command['--broker_token']=row['Token']
+    command['--broker_account']=row['Account']
+    if row['Model ID']!="" or row["Strategy Parameters"]!="":
+        command['--strat_param']=("model_uri="+row['Model ID']+","+row["Strategy Parameters"]) if row["Strategy Parameters"]!="" else ("model_uri="+row['Model ID'])
+    return [(k+"="+str(v)) for k, v in command.items() if v!='']
+
+
+def bars_key(args, ticker):
+    dkwargs = run_BT.data_kwargs(args)
+    return (ticker, dkwargs.get('fromdate'), dkwargs.get('todate'), bt_datafeed_postgres.bars_table(dkwargs.get('timeframe')))
+
+
+def load_all_bars(runs):
+    # one query per distinct date range and table for all the tickers of that range
+    ranges = {}
+    for i, argv in runs:
+        args = run_BT.parse_args(argv)
+        for ticker in args.tickers[0].split(','):
+            ticker, fromdate, todate, table = bars_key(args, ticker)
+            ranges.setdefault((fromdate, todate, table), set()).add(ticker)
+    engine = bt_datafeed_postgres.get_engine(db_cred.dbHost, db_cred.dbUser, db_cred.dbPWD, db_cred.dbName)
+    for (fromdate, todate, table), tickers in ranges.items():
+        universe = bt_datafeed_postgres.load_universe(engine, sorted(tickers), fromdate, todate, table=table)
+        for ticker, bars in universe.items():
+            _BARS[(ticker, fromdate, todate, table)] = bars
+    engine.dispose() # the forked workers must not reuse the connections of the parent
+
+
+def run_row(i, argv):
+    args = run_BT.parse_args(argv)
+    bars = dict((ticker, _BARS[bars_key(args, ticker)]) for ticker in args.tickers[0].split(','))
+    try:
+        return i, run_BT.run(argv, bars=bars), ""
+    except Exception:
+        return i, None, traceback.format_exc()
+
+
+def run_batch(df, processes=None):
+    """
+    runs the backtest rows of a strategy sheet across a pool of processes
+    args:
+        df: strategy sheet, type DataFrame
+        processes: number of worker processes, cpu count if None, type integer
+    returns:
+        list of (row, pnl, error) tuples
+    """
+    runs = [(i, strategy_argv(row)) for i, row in df.iterrows() if str(row['Mode'])=='backtest']
+    for i, row in df.iterrows():
+        if str(row['Mode'])!='backtest':
+            print("Row",i,row['Strategy'],"skipped, mode",row['Mode'])
+    start = time.time()
+    load_all_bars(runs)
+    print("Loaded",len(_BARS),"bar series for",len(runs),"runs in {:.1f}s".format(time.time()-start))
+
+    # fork so that the workers inherit the loaded bars and the imported modules
+    pool = multiprocessing.get_context('fork').Pool(processes)
+    try:
+        results = pool.starmap(run_row, runs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    for i, pnl, error in results:
+        if error:
+            print("Row",i,df.loc[i,'Strategy'],"failed:\n"+error)
+        else:
+            print("Row",i,df.loc[i,'Strategy'],'Profit ... or Loss: {:.2f}'.format(pnl))
+    print("Ran",len(runs),"backtests in {:.1f}s".format(time.time()-start))
+    return results
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=('Run the backtests of the strategy sheet as one job'),
+    )
+
+    parser.add_argument('--strategy_file', required=False, default='',
+                        help='Local strategy sheet, read from Minio airflow-files/strategy.csv if empty')
+
+    parser.add_argument('--processes', required=False, default=0, type=int,
+                        help='Number of worker processes, 0 for the cpu count')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = run_batch(read_strategy_sheet(args.strategy_file), processes=args.processes or None)
+    if any(error for i, pnl, error in results):
+        sys.exit(1)
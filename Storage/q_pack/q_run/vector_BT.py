@@ -0,0 +1,222 @@
+"""
+Vectorized backtest of signal strategies, for parameter sweeps that are too slow through Cerebro.
+
+A signal function turns the bars of a data into the desired position direction (+1, -1, 0 or NaN to
+keep the previous one) at the close of every bar. As with the market orders of the backtrader
+strategies, the position is changed at the open of the next bar, with a fixed stake per data.
+The metrics are the ones strat_performance_analyzer stores in strategy_performance.
+
+Assumptions (see cross_check to verify them against Cerebro for a given setup):
+ - all the datas share the same datetimes
+ - orders are never rejected for lack of cash
+ - percentage commission on the traded value, as broker.setcommission(commission=...)
+
+Sample usage
+    python vector_BT.py --tickers=EUR_USD,GBP_USD --fromdate=2015-1-1 --check
+    python vector_BT.py --tickers=EUR_USD --strat_param=period=20
+"""
+
+import argparse
+import datetime
+import importlib
+import math
+
+import numpy as np
+import backtrader as bt
+
+import q_datafeeds.bt_datafeed_postgres as bt_datafeed_postgres
+import q_credentials.db_secmaster_cred as db_cred
+import q_tools.args_parse_other as args_parse_other
+import q_tools.perf_metrics as perf_metrics
+import ml_pack.features.np_indicators as np_indicators
+
+
+def sma_cross(bars, period=10, minperiod=50):
+    # simple_strategy.St: long above the SMA, short below it, close and reverse on a cross.
+    # St only trades once its longest indicator (SMA 50) is ready
+    close = bars['close']
+    signal = np.sign(close - np_indicators.sma(close, period))
+    signal[:minperiod-1] = np.nan
+    signal[signal == 0] = np.nan # equal to the SMA, nothing is done
+    return signal
+
+
+# strategy module name -> signal function
+SIGNALS = {
+    'simple_strategy': sma_cross,
+}
+
+
+def positions(signal, stake):
+    # position held during every bar, the signal of a bar is executed at the open of the next one
+    held = np.nan_to_num(ffill(signal)) * stake
+    return np.concatenate([[0.0], held[:-1]])
+
+
+def ffill(x):
+    idx = np.where(np.isnan(x), 0, np.arange(len(x)))
+    np.maximum.accumulate(idx, out=idx)
+    out = x[idx]
+    out[np.isnan(x[0]) & (idx == 0)] = np.nan
+    return out
+
+
+def trades(held, open_, commission=0.0):
+    """
+    trades of a position series, a trade is opened when the position leaves 0 or reverses and
+    closed when it goes back to 0 or reverses (as close() followed by buy()/sell())
+    returns:
+        dict of arrays: entry, exit (bar index, -1 if still open), size, pnl, pnlcomm
+    """
+    changes = np.flatnonzero(np.diff(held) != 0) + 1
+    entry = changes[held[changes] != 0]
+    # every change after an entry ends the trade opened there
+    nxt = np.searchsorted(changes, entry, side='right')
+    is_closed = nxt < len(changes)
+    exit_ = np.where(is_closed, changes[np.minimum(nxt, len(changes)-1)], -1)
+    size = held[entry]
+    exit_price = np.where(is_closed, open_[exit_], np.nan)
+    pnl = size * (exit_price - open_[entry])
+    comm = np.abs(size) * commission * (open_[entry] + np.nan_to_num(exit_price))
+    return dict(entry=entry, exit=exit_, size=size, pnl=pnl, pnlcomm=pnl-comm)
+
+
+def run_vector(bars_list, strat_name='simple_strategy', strat_param=None, stake=1000, cash=10000.0, commission=0.0, tann=252.0):
+    """
+    vectorized backtest of a strategy over the bars of one or more datas
+    args:
+        bars_list: bars of every data (see bt_datafeed_postgres.load_universe), type list of dicts
+        strat_name: strategy module name in SIGNALS, type string
+        strat_param: keyword arguments of the signal function, type dict
+        stake: units per position, as the FixedSize sizer of run_BT, type integer
+        cash: starting cash, type float
+        commission: percentage commission on the traded value, type float
+        tann: periods per year of the bars, type float
+    returns:
+        tuple (metrics dict, value array)
+    """
+    for bars in bars_list[1:]:
+        if not np.array_equal(bars['datetime'], bars_list[0]['datetime']):
+            raise ValueError("the datas must share the same datetimes for the vectorized backtest")
+    value = np.full(len(bars_list[0]['datetime']), float(cash))
+    closed, n_open = [], 0
+    for i, bars in enumerate(bars_list):
+        held = positions(SIGNALS[strat_name](bars, **(strat_param or {})), stake)
+        traded = np.diff(held, prepend=0.0)
+        cash_flow = traded * bars['open'] + np.abs(traded) * bars['open'] * commission
+        value += held * bars['close'] - np.cumsum(cash_flow)
+        t = trades(held, bars['open'], commission)
+        is_closed = t['exit'] >= 0
+        n_open += int((~is_closed).sum())
+        closed.append(np.column_stack([t['exit'][is_closed], np.full(is_closed.sum(), i), t['pnlcomm'][is_closed]]))
+    closed = np.concatenate(closed)
+    closed = closed[np.lexsort((closed[:, 1], closed[:, 0]))] # closing order: bar, then data
+    return perf_metrics.performance(value, closed[:, 2], n_open, cash, tann=tann), value
+
+
+def run_cerebro(bars_list, strat_name='simple_strategy', strat_param=None, stake=1000, cash=10000.0, commission=0.0, tann=252.0):
+    # same backtest through Cerebro, with the analyzers of strat_performance_analyzer (without the DB write)
+    module = importlib.import_module('q_strategies.' + strat_name)
+    cerebro = bt.Cerebro(stdstats=False)
+    for i, bars in enumerate(bars_list):
+        cerebro.adddata(bt_datafeed_postgres.Memory_Bars(bars=bars, name=str(i)))
+    cerebro.broker.setcash(cash)
+    cerebro.broker.setcommission(commission=commission)
+    cerebro.addsizer(bt.sizers.FixedSize, stake=stake)
+    cerebro.addstrategy(module.St, **(strat_param or {}))
+    cerebro.addanalyzer(bt.analyzers.Returns, _name='returns', tann=tann)
+    cerebro.addanalyzer(bt.analyzers.SQN, _name='sqn')
+    cerebro.addanalyzer(bt.analyzers.DrawDown, _name='drawdown')
+    cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name='trades')
+    strat = cerebro.run()[0]
+    ta = strat.analyzers.trades.get_analysis()
+    returns = strat.analyzers.returns.get_analysis()
+    drawdown = strat.analyzers.drawdown.get_analysis()
+    perf = {}
+    perf['total_open'] = ta.total.open
+    perf['total_closed'] = ta.total.closed
+    perf['total_won'] = ta.won.total
+    perf['total_lost'] = ta.lost.total
+    perf['win_streak'] = ta.streak.won.longest
+    perf['lose_streak'] = ta.streak.lost.longest
+    perf['pnl_net'] = round(ta.pnl.net.total, 2)
+    perf['strike_rate'] = (perf['total_won'] / perf['total_closed']) * 100
+    perf['sqn'] = strat.analyzers.sqn.get_analysis()['sqn']
+    perf['total_compound_return'] = returns['rtot']
+    perf['avg_return'] = returns['ravg']
+    perf['annual_norm_return'] = returns['rnorm100']
+    perf['max_draw_per'] = drawdown['max']['drawdown']
+    perf['max_draw_val'] = drawdown['max']['moneydown']
+    perf['max_draw_len'] = drawdown['max']['len']
+    return perf
+
+
+def cross_check(bars_list, rtol=1e-6, **kwargs):
+    """
+    runs the vectorized and the Cerebro backtest with the same arguments and compares the metrics
+    returns:
+        dict of metric -> (vectorized, cerebro) for the metrics that differ, empty if they all match
+    """
+    vector, _ = run_vector(bars_list, **kwargs)
+    cerebro = run_cerebro(bars_list, **kwargs)
+    diff = {}
+    for k, v in vector.items():
+        c = cerebro[k]
+        if v is None or c is None:
+            same = v is None and c is None
+        else:
+            same = math.isclose(v, c, rel_tol=rtol, abs_tol=1e-9)
+        if not same:
+            diff[k] = (v, c)
+    return diff
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=('Vectorized backtest of a signal strategy'),
+    )
+
+    parser.add_argument('--tickers', nargs='*' ,required=False,default=['EUR_USD,GBP_USD'], type=str,
+                        help='Pass the tickers with space')
+
+    parser.add_argument('--fromdate', required=False, default='2010-1-1',
+                        help='Date in YYYY-MM-DD format')
+
+    parser.add_argument('--todate', required=False, default='2019-7-30',
+                        help='Date in YYYY-MM-DD format')
+
+    parser.add_argument('--cash', default=10000, type=float,
+                        help='Starting cash')
+
+    parser.add_argument('--commission', default=0.0, type=float,
+                        help='Percentage commission on the traded value')
+
+    parser.add_argument('--strat_name', required=False, default='simple_strategy',
+                        help='Strategy module with a signal function in SIGNALS')
+
+    parser.add_argument('--strat_param', required=False, default=dict(),
+                        action=args_parse_other.StoreDictKeyPair, metavar='kwargs', help='kwargs in k1=v1,k2=v2 format')
+
+    parser.add_argument('--check', required=False, default=False, type=args_parse_other.str2bool, const=True, nargs='?',
+                        help='Cross check the metrics against a Cerebro run')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    engine = bt_datafeed_postgres.get_engine(db_cred.dbHost, db_cred.dbUser, db_cred.dbPWD, db_cred.dbName)
+    fromdate = datetime.datetime.strptime(args.fromdate, '%Y-%m-%d')
+    todate = datetime.datetime.strptime(args.todate, '%Y-%m-%d')
+    tickers = args.tickers[0].split(',')
+    universe = bt_datafeed_postgres.load_universe(engine, tickers, fromdate, todate)
+    bars_list = [universe[ticker] for ticker in tickers]
+    strat_param = dict((k, int(v)) for k, v in args.strat_param.items())
+    kwargs = dict(strat_name=args.strat_name, strat_param=strat_param, cash=args.cash, commission=args.commission)
+    metrics, value = run_vector(bars_list, **kwargs)
+    for k, v in metrics.items():
+        print(k, v)
+    if args.check:
+        diff = cross_check(bars_list, **kwargs)
+        print("Cross check with Cerebro:", "OK" if not diff else diff)
@@ -31,7 +31,7 @@ class St(bt.Strategy):
     def __init__(self):
         self.ml_log = []
         self.db_run_id = None
-        self.sma = [bt.indicators.SimpleMovingAverage(d, period=10) for d in self.datas]
+        self.sma = [bt.indicators.SimpleMovingAverage(d, period=self.p.period) for d in self.datas]
         self.sma2 = [bt.indicators.SimpleMovingAverage(d, period=20) for d in self.datas]
         self.sma3 = [bt.indicators.SimpleMovingAverage(d, period=50) for d in self.datas]
         for i in self.sma:
@@ -5,7 +5,12 @@ import psycopg2
 import pandas as pd
 import os
 
-import mlflow.pyfunc
+import numpy as np
+
+from ml_pack.features import np_indicators
+from ml_pack.serving import model_cache
+from ml_pack.serving import model_server
+import q_tools.args_parse_other as args_parse_other
 
 class St(bt.Strategy):
     alias = 'Simple Strategy'
@@ -14,7 +19,11 @@ class St(bt.Strategy):
         limdays=200,
         backtest=True,
         ml_serving=False,
-        model_uri="24cbdab283244fac8d54405d58b2bbf1"
+        ml_precompute=False, # backtest only, scores all the bars before the run
+        model_uri="24cbdab283244fac8d54405d58b2bbf1",
+        ml_server="", # unix socket of a running model_server, the model is loaded locally if empty
+        rsi_period=30,
+        stoc_period=20,
     )
 
 
@@ -25,9 +34,9 @@ class St(bt.Strategy):
 
     def __init__(self): 
         self.db_run_id = None
-        self.rsi = [bt.indicators.RSI(d, period=30) for d in self.datas]
+        self.rsi = [bt.indicators.RSI(d, period=self.p.rsi_period) for d in self.datas]
 
-        self.stoc = [bt.indicators.Stochastic(d, period=20) for d in self.datas]
+        self.stoc = [bt.indicators.Stochastic(d, period=self.p.stoc_period) for d in self.datas]
         self.atr = [bt.indicators.ATR(d, period=5) for d in self.datas]
         for i in self.rsi:
             i.aliased='RSI'
@@ -47,7 +56,38 @@ class St(bt.Strategy):
 
         if self.p.ml_serving:
             print("s3://mlflow-models/"+self.p.model_uri+"/artifacts/model")
-            self.model_predict=mlflow.pyfunc.load_model(model_uri=("s3://mlflow-models/"+self.p.model_uri+"/artifacts/model"))
+            if self.p.ml_server:
+                self.model_predict=model_server.RemotePredictor(self.p.model_uri, address=self.p.ml_server)
+            else:
+                self.model_predict=model_cache.load_model(self.p.model_uri) # local copy of the model artifacts, downloaded once per worker
+
+        self.signal = None
+        if self.p.ml_serving and self.p.backtest and args_parse_other.str2bool(self.p.ml_precompute):
+            self.signal = self.precompute_signals()
+
+    def precompute_signals(self):
+        # The datas are preloaded before the strategy is created, so the features of every bar are known.
+        # Computes them in numpy and scores all the bars of all the datas with a single model call
+        if not all(len(d.close.array) for d in self.datas):
+            print("Datas not preloaded, predicting bar by bar")
+            return None
+
+        features, valid_idx = [], []
+        for d in self.datas:
+            rsi = np_indicators.rsi(d.close.array, period=self.p.rsi_period)
+            stoc, _ = np_indicators.stochastic(d.high.array, d.low.array, d.close.array, period=self.p.stoc_period)
+            valid = np.flatnonzero(~np.isnan(rsi) & ~np.isnan(stoc))
+            features.append(np.column_stack([rsi[valid], stoc[valid]]))
+            valid_idx.append(valid)
+
+        preds = np.asarray(self.model_predict.predict(np.vstack(features))).ravel()
+        signal, start = [], 0
+        for d, valid in zip(self.datas, valid_idx):
+            sig = np.full(len(d.close.array), np.nan)
+            sig[valid] = preds[start:start+len(valid)]
+            start += len(valid)
+            signal.append(sig)
+        return signal
 
 
     def notify_data(self, data, status, *args, **kwargs):
@@ -71,36 +111,50 @@ class St(bt.Strategy):
 
 
 
+    def rsi_signal(self, i):
+        # True for long, False for short and None for no decision
+        if self.rsi[i] < 40:
+            return True
+        elif self.rsi[i] > 60:
+            return False
+        return None
+
     def next(self): 
-        for i, d in enumerate(self.datas):
-            dt, dn = self.datetime.datetime(), d._name
-            pos = self.getposition(d).size
-            order_valid = datetime.timedelta(self.p.limdays)
-            if self.datastatus and pos==0:
-                if self.p.ml_serving:
-                    pred=self.model_predict.predict([[self.rsi[i][0],self.stoc[i][0]]])[0]
-                    if pred>0:
-                        price_sl = d.close[0]-(self.atr[0] * 1)
-                        price_tp = d.close[0]+(self.atr[0] * 2)
-                        self.order=self.buy_bracket(data=d,exectype=bt.Order.Market , stopprice=price_sl, limitprice=price_tp, valid=order_valid) #, valid=order_valid,price=None
-                        self.log('BUY CREATE {:.2f} at {}'.format(d.close[0],dn))
-                    elif pred<=0:
-                        price_sl = d.close[0]+(self.atr[0] * 1)
-                        price_tp = d.close[0]-(self.atr[0] * 2)
-                        self.order=self.sell_bracket(data=d,exectype=bt.Order.Market, stopprice=price_sl, limitprice=price_tp, valid=order_valid)
-                        self.log('SELL CREATE {:.2f} at {}'.format(d.close[0],dn))
-
-                elif self.rsi[i] < 40:
-                    price_sl = d.close[0]-(self.atr[0] * 1)
-                    price_tp = d.close[0]+(self.atr[0] * 2)
-                    self.order=self.buy_bracket(data=d,exectype=bt.Order.Market , stopprice=price_sl, limitprice=price_tp, valid=order_valid) #, valid=order_valid,price=None
-                    self.log('BUY CREATE {:.2f} at {}'.format(d.close[0],dn))
-
-                elif self.rsi[i] > 60:
-                    price_sl = d.close[0]+(self.atr[0] * 1)
-                    price_tp = d.close[0]-(self.atr[0] * 2)
-                    self.order=self.sell_bracket(data=d,exectype=bt.Order.Market, stopprice=price_sl, limitprice=price_tp, valid=order_valid)
-                    self.log('SELL CREATE {:.2f} at {}'.format(d.close[0],dn))
+        order_valid = datetime.timedelta(self.p.limdays)
+        if not self.datastatus:
+            return
+
+        # datas waiting for a decision at this bar
+        pending = [(i, d) for i, d in enumerate(self.datas) if self.getposition(d).size==0]
+        if not pending:
+            return
+
+        if self.signal is not None:
+            # precomputed, the bar index of a data is its length - 1
+            preds = [self.signal[i][len(d)-1] for i, d in pending]
+            signals = [pred>0 for pred in preds]
+        elif self.p.ml_serving:
+            # one model call for every pending data instead of one per data
+            features = [[self.rsi[i][0],self.stoc[i][0]] for i, d in pending]
+            preds = self.model_predict.predict(features)
+            signals = [pred>0 for pred in preds]
+        else:
+            signals = [self.rsi_signal(i) for i, d in pending]
+
+        for (i, d), go_long in zip(pending, signals):
+            dn = d._name
+            if go_long is None:
+                continue
+            elif go_long:
+                price_sl = d.close[0]-(self.atr[0] * 1)
+                price_tp = d.close[0]+(self.atr[0] * 2)
+                self.order=self.buy_bracket(data=d,exectype=bt.Order.Market , stopprice=price_sl, limitprice=price_tp, valid=order_valid) #, valid=order_valid,price=None
+                self.log('BUY CREATE {:.2f} at {}'.format(d.close[0],dn))
+            else:
+                price_sl = d.close[0]+(self.atr[0] * 1)
+                price_tp = d.close[0]-(self.atr[0] * 2)
+                self.order=self.sell_bracket(data=d,exectype=bt.Order.Market, stopprice=price_sl, limitprice=price_tp, valid=order_valid)
+                self.log('SELL CREATE {:.2f} at {}'.format(d.close[0],dn))
 
     def stop(self):
         print("Strategy run finished with Run ID:",self.db_run_id)
\ No newline at end of file
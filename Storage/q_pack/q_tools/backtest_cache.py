@@ -0,0 +1,126 @@
+"""
+Result cache of the run_BT backtests, in the backtest_cache table of risk_db.
+
+A backtest is keyed by the source of its strategy module and of run_BT, with all the q_pack modules they
+import (directly or through other q_pack modules: feeds, analyzers, tools), all its run_BT arguments but
+the ones in UNKEYED_ARGS, and a fingerprint of the bars it reads (per ticker: number of bars and max
+last_updated_date in the range, from the table of its timeframe).
+A repeated backtest returns the run_id and metrics of the stored run instead of running and inserting
+the same rows again; a change of the code, of the arguments or of the data gives a new key.
+
+Sample usage (see run_BT.run)
+    key = cache_key(args, data_fingerprint(engine, tickers, fromdate, todate))
+    hit = lookup(conn, key) # (run_id, pnl, strategy_performance dict) or None
+    store(conn, key, run_id, pnl)
+"""
+
+import ast
+import datetime
+import hashlib
+import importlib.util
+import json
+import os
+
+import q_datafeeds.bt_datafeed_postgres as bt_datafeed_postgres
+
+Q_PACK = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# run_BT code run for every backtest, with the modules it imports
+RUN_MODULES = ['q_run.run_BT']
+# run_BT arguments which don't change the result of a backtest
+UNKEYED_ARGS = ('use_cache', 'plot', 'mode', 'broker_token', 'broker_account', 'checkpoint')
+
+FINGERPRINT_SQL = ("select stock_id, count(*), max(last_updated_date) from {table} where stock_id = ANY(%(ids)s)"
+                   " and date_price between %(fromdate)s and %(todate)s group by stock_id")
+
+
+def module_path(name):
+    # source file of a q_pack module, None for the other modules (standard library, site packages)
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return None
+    if spec is None or not spec.origin or not spec.origin.endswith('.py'):
+        return None
+    return spec.origin if os.path.abspath(spec.origin).startswith(Q_PACK + os.sep) else None
+
+
+def imported_names(source):
+    # modules named by the import statements of a source (for "from a import b", both a and a.b)
+    names = []
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Import):
+            names += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.append(node.module)
+            names += [node.module + '.' + alias.name for alias in node.names if alias.name != '*']
+    return names
+
+
+def code_hash(strat_name):
+    # hash of the source of the q_strategies module, of run_BT and of all the q_pack modules they import
+    digest = hashlib.sha1()
+    seen, todo = set(), ['q_strategies.' + strat_name] + RUN_MODULES
+    while todo:
+        path = module_path(todo.pop())
+        if path is None or path in seen:
+            continue
+        seen.add(path)
+        with open(path, 'rb') as f:
+            source = f.read()
+        todo += imported_names(source)
+    for path in sorted(seen):
+        with open(path, 'rb') as f:
+            digest.update(os.path.relpath(path, Q_PACK).encode() + b'\0' + f.read())
+    return digest.hexdigest()
+
+
+def data_fingerprint(engine, tickers, fromdate, todate, table='daily_data'):
+    """
+    fingerprint of the bars of the tickers in a date range
+    returns:
+        dict of ticker -> [number of bars, max last_updated_date as string]
+    """
+    with engine.connect() as conn:
+        ids = bt_datafeed_postgres.symbol_ids(conn, list(tickers))
+        fromdate, todate = bt_datafeed_postgres.date_params(fromdate, todate)
+        rows = conn.execute(FINGERPRINT_SQL.format(table=table), ids=list(ids.values()), fromdate=fromdate, todate=todate).fetchall()
+    by_id = dict((r[0], [r[1], str(r[2])]) for r in rows)
+    return dict((ticker, by_id.get(ids.get(ticker), [0, None])) for ticker in tickers)
+
+
+def cache_key(args, fingerprint):
+    """
+    key of a backtest
+    args:
+        args: parsed run_BT arguments
+        fingerprint: see data_fingerprint
+    returns:
+        hex string
+    """
+    key = dict((k, str(v)) for k, v in vars(args).items() if k not in UNKEYED_ARGS) # lean_perf, ml_log, cerebro, ...
+    key.update({'strat_param': sorted((str(k), str(v)) for k, v in args.strat_param.items()),
+                'code_hash': code_hash(args.strat_name), 'data': fingerprint})
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def lookup(conn, key):
+    """
+    returns:
+        (run_id, pnl, strategy_performance dict) of the cached run, None if the key is not cached
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT c.run_id, c.pnl, p.* FROM backtest_cache c LEFT JOIN strategy_performance p ON p.run_id = c.run_id WHERE c.cache_key = %s", (key,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    names = [d[0] for d in cur.description][2:]
+    performance = dict((n, v) for n, v in zip(names, row[2:]) if n not in ('id', 'run_id'))
+    return row[0], (float(row[1]) if row[1] is not None else None), performance
+
+
+def store(conn, key, run_id, pnl):
+    cur = conn.cursor()
+    cur.execute("INSERT INTO backtest_cache (cache_key, run_id, pnl, recorded_time) VALUES (%s, %s, %s, %s) ON CONFLICT (cache_key) DO NOTHING",
+                (key, run_id, pnl, datetime.datetime.now()))
+    conn.commit()
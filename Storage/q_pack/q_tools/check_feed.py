@@ -0,0 +1,96 @@
+"""
+Checks that the paged reads of the Postgres feeds (chunk_rows, prefetch) give the same bars as the single query
+of load_universe, for the tickers and date range of a backtest.
+
+Sample usage
+    python -m q_tools.check_feed --tickers EUR_USD,GBP_USD --fromdate 2019-1-1 --todate 2019-7-30 --dargs "timeframe=bt.TimeFrame.Minutes"
+"""
+
+import argparse
+import datetime
+
+import backtrader as bt
+import numpy as np
+
+import q_datafeeds.bt_datafeed_postgres as bt_datafeed_postgres
+import q_credentials.db_secmaster_cred as db_cred
+
+COLUMNS = ['datetime', 'open', 'high', 'low', 'close']
+
+
+def feed_bars(feed, **kwargs):
+    """
+    bars read by a feed through cerebro
+    returns:
+        dict of numpy arrays as load_universe
+    """
+    cerebro = bt.Cerebro(stdstats=False)
+    data = feed(**kwargs)
+    cerebro.adddata(data)
+    cerebro.addstrategy(bt.Strategy)
+    cerebro.run()
+    return dict((col, np.array(getattr(data.lines, col).array, dtype=float)) for col in COLUMNS)
+
+
+def check_paged(tickers, fromdate=datetime.datetime.min, todate=datetime.datetime.max, timeframe=None,
+                chunk_rows=(1000, 50000), credentials=None, **filters):
+    """
+    compares the bars of every ticker read in pages of chunk_rows bars, with and without prefetch, to load_universe
+    args:
+        credentials: dbHost, dbUser, dbPWD, dbName of the securities master, db_secmaster_cred if None, type dict
+        filters: sessions, weekdays, holidays as in bt_datafeed_postgres.filter_params
+    returns:
+        list of (ticker, chunk_rows, prefetch) whose bars differ, empty if they all match
+    """
+    credentials = credentials or dict(dbHost=db_cred.dbHost, dbUser=db_cred.dbUser, dbPWD=db_cred.dbPWD, dbName=db_cred.dbName)
+    table = bt_datafeed_postgres.bars_table(timeframe)
+    engine = bt_datafeed_postgres.get_engine(**credentials)
+    universe = bt_datafeed_postgres.load_universe(engine, tickers, fromdate, todate, table=table, **filters)
+    feed = bt_datafeed_postgres.PostgreSQL_Minute if table == 'minute_data' else bt_datafeed_postgres.PostgreSQL_Daily
+    mismatches = []
+    for ticker in tickers:
+        # the feeds drop the bars outside of fromdate..todate themselves, as Memory_Bars does
+        expected = feed_bars(bt_datafeed_postgres.Memory_Bars, bars=universe[ticker], fromdate=fromdate, todate=todate, **filters)
+        for rows in chunk_rows:
+            for prefetch in (False, True):
+                bars = feed_bars(feed, ticker=ticker, fromdate=fromdate, todate=todate, chunk_rows=rows, prefetch=prefetch,
+                                 **dict(credentials, **filters))
+                if not all(np.array_equal(bars[col], expected[col]) for col in COLUMNS):
+                    mismatches.append((ticker, rows, prefetch))
+        print(ticker, len(expected['datetime']), 'bars', 'match' if not any(m[0] == ticker for m in mismatches) else 'DIFFER')
+    return mismatches
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=('Compare the paged Postgres feeds to the single query load'),
+    )
+
+    parser.add_argument('--tickers', required=False, default='EUR_USD,GBP_USD',
+                        help='Tickers separated by commas')
+
+    parser.add_argument('--dargs', default='',
+                        metavar='kwargs', help='data kwargs of run_BT in k1=v1,k2=v2 format (timeframe, sessions, weekdays, holidays)')
+
+    parser.add_argument('--fromdate', required=False, default='2010-1-1',
+                        help='Date[time] in YYYY-MM-DD[THH:MM:SS] format')
+
+    parser.add_argument('--todate', required=False, default='2019-7-30',
+                        help='Date[time] in YYYY-MM-DD[THH:MM:SS] format')
+
+    parser.add_argument('--chunk_rows', required=False, default='1000,50000',
+                        help='Page sizes to check, separated by commas')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    import q_run.run_BT as run_BT
+    args = parse_args()
+    dkwargs = run_BT.data_kwargs(args)
+    filters = dict((k, dkwargs[k]) for k in ('sessions', 'weekdays', 'holidays') if k in dkwargs)
+    mismatches = check_paged(args.tickers.split(','), dkwargs['fromdate'], dkwargs['todate'], dkwargs.get('timeframe'),
+                             [int(r) for r in args.chunk_rows.split(',')], **filters)
+    if mismatches:
+        raise SystemExit("paged bars differ from the single query: " + str(mismatches))
@@ -0,0 +1,65 @@
+"""
+Local disk cache of Minio objects read while the Airflow scheduler parses the DAG files.
+
+An object is checked against Minio (by ETag) at most once every ttl seconds, and only downloaded
+again when its ETag changed, so a parse normally does no network I/O. When Minio can't be reached
+the last cached copy is used, and Minio is tried again after ttl seconds.
+
+Sample usage
+    path = cached_object("airflow-files", "strategy.csv")
+    path = cached_object("airflow-files", "interested_tickers.xlsx", convert=tickers_to_json, suffix=".json")
+"""
+
+import os
+import time
+
+CACHE_DIR = os.environ.get("MINIO_CACHE_DIR", "/tmp/minio_cache")
+
+
+def refresh(bucket, key, path, etag_path, convert=None):
+    import boto3
+    from botocore.config import Config
+    s3 = boto3.client('s3',endpoint_url="http://minio-image:9000",aws_access_key_id="minio-image",aws_secret_access_key="minio-image-pass",
+                      config=Config(connect_timeout=2, read_timeout=5, retries={'max_attempts': 1}))
+    etag = s3.head_object(Bucket=bucket, Key=key)['ETag']
+    if os.path.exists(path) and os.path.exists(etag_path) and open(etag_path).read()==etag:
+        return # unchanged
+    body = s3.get_object(Bucket=bucket, Key=key, IfMatch=etag)['Body'].read()
+    if convert is not None:
+        body = convert(body)
+    # written to temporary files first so that a concurrent parse never reads a partial object
+    with open(path+".tmp", "wb") as f:
+        f.write(body)
+    with open(etag_path+".tmp", "w") as f:
+        f.write(etag)
+    os.replace(path+".tmp", path)
+    os.replace(etag_path+".tmp", etag_path)
+
+
+def cached_object(bucket, key, ttl=300, convert=None, suffix=""):
+    """
+    path of the local copy of a Minio object, refreshed if older than ttl
+    args:
+        bucket, key: the Minio object, type string
+        ttl: seconds a cached copy is used without checking Minio, type integer
+        convert: function of the object bytes returning the bytes to cache, type function
+        suffix: appended to the cached file name (e.g. the extension of the converted object), type string
+    returns:
+        path of the cached file, None if the object was never cached
+    """
+    path = os.path.join(CACHE_DIR, bucket, key + suffix)
+    etag_path = path + ".etag"
+    checked_path = path + ".checked" # mtime: last time Minio was checked, successfully or not
+    if not os.path.exists(checked_path) or time.time()-os.path.getmtime(checked_path) > ttl:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            refresh(bucket, key, path, etag_path, convert=convert)
+        except Exception as e:
+            print("Minio object", bucket+"/"+key, "not refreshed, using the cached copy:", e)
+        try:
+            # while Minio is down the parses also wait ttl before trying again
+            with open(checked_path, "a"):
+                os.utime(checked_path, None)
+        except OSError:
+            pass
+    return path if os.path.exists(path) else None
@@ -0,0 +1,57 @@
+"""
+strategy_performance metrics computed in one vectorized pass from the equity curve and the closed trades.
+
+The metrics are the ones of the backtrader analyzers used by strat_performance_analyzer
+(TradeAnalyzer, SQN, Returns and DrawDown), see vector_BT.cross_check.
+"""
+
+import math
+
+import numpy as np
+
+
+def longest_streak(flags):
+    if not len(flags):
+        return 0
+    runs = np.diff(np.flatnonzero(np.diff(np.concatenate([[0], flags.astype(int), [0]]))))[::2]
+    return int(runs.max()) if len(runs) else 0
+
+
+def performance(value, closed_pnl, n_open, cash, tann=252.0):
+    """
+    strategy_performance metrics, as computed from the backtrader analyzers
+    args:
+        value: broker value at the close of every bar, type array
+        closed_pnl: pnlcomm of the closed trades in closing order, type array
+        n_open: trades still open at the end, type integer
+        cash: broker value at the start, type float
+        tann: periods per year of the bars for the annualized return (252 for daily), type float
+    returns:
+        dict
+    """
+    perf = {}
+    won = closed_pnl >= 0.0
+    perf['total_open'] = n_open
+    perf['total_closed'] = len(closed_pnl)
+    perf['total_won'] = int(won.sum())
+    perf['total_lost'] = int((~won).sum())
+    perf['win_streak'] = longest_streak(won)
+    perf['lose_streak'] = longest_streak(~won)
+    perf['pnl_net'] = round(float(closed_pnl.sum()), 2)
+    perf['strike_rate'] = (perf['total_won'] / perf['total_closed']) * 100 if len(closed_pnl) else None
+    if len(closed_pnl) > 1:
+        std = closed_pnl.std()
+        perf['sqn'] = math.sqrt(len(closed_pnl)) * closed_pnl.mean() / std if std else None
+    else:
+        perf['sqn'] = 0
+    rtot = math.log(value[-1] / cash) if value[-1] > 0 else float('-inf')
+    perf['total_compound_return'] = rtot
+    perf['avg_return'] = ravg = rtot / len(value)
+    perf['annual_norm_return'] = (math.expm1(ravg * tann) if ravg > float('-inf') else ravg) * 100.0
+    peak = np.maximum.accumulate(value)
+    moneydown = peak - value
+    drawdown = 100.0 * moneydown / peak
+    perf['max_draw_per'] = float(drawdown.max())
+    perf['max_draw_val'] = float(moneydown.max())
+    perf['max_draw_len'] = longest_streak(drawdown != 0)
+    return perf
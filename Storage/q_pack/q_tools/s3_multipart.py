@@ -0,0 +1,82 @@
+from io import BytesIO
+
+MIN_PART_SIZE = 5 * 1024 * 1024 # S3 minimum size of every part but the last
+
+
+class S3MultipartWriter(object):
+    """
+    Write only file object streaming to an S3/Minio object through a multipart upload.
+    At most part_size bytes are held in memory, small objects fall back to a single put_object.
+
+    Sample usage
+    with S3MultipartWriter(s3, Bucket, Key) as out:
+        out.write(chunk)
+    """
+
+    def __init__(self, s3, bucket, key, part_size=8 * 1024 * 1024):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.buffer = BytesIO()
+        self.parts = []
+        self.upload_id = None
+        self.position = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.buffer.write(data)
+        self.position += len(data)
+        if self.buffer.tell() >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                       PartNumber=part_number, Body=self.buffer.getvalue())
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = BytesIO()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is None:
+            self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=self.buffer.getvalue())
+        else:
+            if self.buffer.tell():
+                self._upload_part()
+            self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                              MultipartUpload={'Parts': self.parts})
+        self.buffer = BytesIO()
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        self.buffer = BytesIO()
@@ -1,4 +1,17 @@
 import psycopg2
+import psycopg2.extras
+import q_credentials.db_risk_cred as db_risk_cred
+
+_risk_conn = None
+
+
+def risk_db_conn():
+    # one risk_db connection per process, shared by the analyzers of all the runs of that process
+    global _risk_conn
+    if _risk_conn is None or _risk_conn.closed:
+        _risk_conn = psycopg2.connect(host=db_risk_cred.dbHost , database=db_risk_cred.dbName, user=db_risk_cred.dbUser, password=db_risk_cred.dbPWD)
+    return _risk_conn
+
 
 def write_to_db(conn, data_dict, table, return_col=""):
     cols= data_dict.keys()
@@ -16,4 +29,14 @@ def write_to_db(conn, data_dict, table, return_col=""):
     db_run_id = cur.fetchall()[0][0] # fetching the value returned by ".....RETURNING ___"
     conn.commit()
     if db_run_id:
-        return db_run_id
\ No newline at end of file
+        return db_run_id
+
+def write_many_to_db(conn, rows, table):
+    # rows: list of dicts with the same keys, inserted with one statement per 1000 rows
+    if not rows:
+        return
+    cols = list(rows[0].keys())
+    sql = """INSERT INTO """+table+"""("""+", ".join(cols)+""") VALUES %s"""
+    template = "("+", ".join('%('+i+')s' for i in cols)+")"
+    psycopg2.extras.execute_values(conn.cursor(), sql, rows, template=template, page_size=1000)
+    conn.commit()